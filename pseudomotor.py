@@ -4,7 +4,107 @@ import os
 import random
 import requests
 import json
+import concurrent.futures
+import logging
+import queue
+import threading
 import serial
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _rechazar_no_finito(valor):
+    """json.loads acepta NaN e Infinity, que no son JSON estándar; orjson los rechaza. Igualamos ambos."""
+    raise ValueError(f"Valor no finito en la trama: {valor}")
+
+
+def _float_finito(texto):
+    """Como float(), pero rechaza los números que desbordan a inf (p. ej. 1e999)."""
+    valor = float(texto)
+    if not math.isfinite(valor):
+        _rechazar_no_finito(texto)
+    return valor
+
+
+# Parser JSON para las tramas del ESP32: orjson (en C, acepta bytes) si está instalado.
+# Con cualquiera de los dos, una trama con valores no finitos se descarta como malformada.
+if orjson:
+    _json_loads = orjson.loads
+else:
+    def _json_loads(trama):
+        return json.loads(trama, parse_constant=_rechazar_no_finito, parse_float=_float_finito)
+
+# Los mensajes de cada ciclo de control van a DEBUG: con INFO no se formatean ni se escriben.
+log = logging.getLogger("caren")
+
+# Alcance máximo del Lidar. Un ángulo sin lectura se toma como libre hasta esta distancia: un valor
+# finito, porque el estado se envía al servidor de entrenamiento y JSON no admite inf ni NaN
+LIDAR_ALCANCE_MAX = 1200.0
+
+# Valores por defecto cuando la trama no trae un sensor (compartidos, no se modifican)
+_LIDAR_VACIO = np.full(360, LIDAR_ALCANCE_MAX, dtype=np.float32) # Ningún obstáculo conocido en ningún ángulo
+_POSICION_VACIA = {"x": 0, "y": 0, "orientacion": 0}
+_VACIO = {}
+
+# Acciones posibles del robot, en orden de prioridad para la evasión de obstáculos
+_ACCIONES = ("AVANZAR", "GIRAR_DERECHA", "GIRAR_IZQUIERDA", "RETROCEDER", "DETENIDO")
+
+
+def _a_json(obj):
+    """Convierte los tipos de NumPy del estado en tipos serializables a JSON."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+
+def _json_dumps(obj):
+    """
+    Serializa el estado a JSON (bytes). orjson convierte los arrays de NumPy directamente en C.
+    El estado no lleva valores no finitos (el Lidar sin lectura vale LIDAR_ALCANCE_MAX y las tramas
+    con NaN o inf se descartan al leerlas). El respaldo con json usa los mismos separadores compactos
+    que orjson y se niega a escribir NaN/Infinity (ValueError), que no son JSON estándar: el servidor
+    los rechazaría.
+    """
+    if orjson:
+        return orjson.dumps(obj, default=_a_json, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=_a_json, separators=(",", ":"), allow_nan=False).encode('utf-8')
+
+
+# Mínimo de un sector del Lidar entre dos ángulos ya normalizados (0-359); si inicio > fin el sector cruza el 0.
+# Con numba se compila a un bucle nativo.
+if njit is not None:
+    @njit(cache=True)
+    def _sector_min(lidar, inicio, fin):
+        minimo = np.inf
+        if inicio <= fin:
+            for i in range(inicio, fin + 1):
+                if lidar[i] < minimo:
+                    minimo = lidar[i]
+        else:
+            for i in range(inicio, lidar.shape[0]):
+                if lidar[i] < minimo:
+                    minimo = lidar[i]
+            for i in range(0, fin + 1):
+                if lidar[i] < minimo:
+                    minimo = lidar[i]
+        return minimo
+else:
+    def _sector_min(lidar, inicio, fin):
+        if inicio <= fin:
+            return lidar[inicio:fin+1].min()
+        return min(lidar[inicio:].min(), lidar[:fin+1].min())
+
+
 class RobotController:
     """
     Clase que encapsula toda la lógica de movilidad del proyecto Caren.
@@ -12,27 +112,90 @@ class RobotController:
     def __init__(self):
         # --- Constantes y Configuración ---
         self.DATA_COLLECTION_URL = "http://127.0.0.1:5000/log"
+        self.DATA_COLLECTION_BATCH_URL = self.DATA_COLLECTION_URL + "/batch"
+        self.REGISTRO_TAMANO_LOTE = 20 # Muestras por envío al servidor de datos
+        self.REGISTRO_INTERVALO_MAX = 2.0 # Segundos máximos que una muestra espera en el lote
         self.AI_PREDICTION_URL = "http://127.0.0.1:5000/predict" # URL futura para predicciones
         self.RUTA_MODELO_IA = "models/caren_model.h5" # Ruta simulada
 
         # --- Configuración del Puerto Serie ---
         self.SERIAL_PORT = '/dev/ttyUSB0' # Cambiar por el puerto correcto (ej. 'COM3' en Windows)
         self.BAUD_RATE = 115200
+        # Una línea más larga que esto se descarta como basura (una trama con Lidar ocupa ~5 KB).
+        self.SERIAL_MAX_PENDIENTE = 64 * 1024
+        # Formato de trama del ESP32: False = JSON por líneas (firmware actual), True = prefijo de longitud
+        self.SERIAL_TRAMAS_CON_LONGITUD = False
+        self.SENSORES_MAX_ANTIGUEDAD = 1.0 # Segundos sin tramas tras los que los datos se consideran obsoletos
         self.ser = None
         
+        # --- Sectores del Lidar (ángulos inicio/fin ya normalizados, fijos) ---
+        self._sector_frontal = (315, 45)     # -45 a 45 grados
+        self._sector_derecha = (225, 315)    # -135 a -45 grados
+        self._sector_izquierda = (45, 135)   # 45 a 135 grados
+        _sector_min(_LIDAR_VACIO, *self._sector_frontal) # Compila el kernel ahora y no en el primer ciclo
+
         # --- Estado del Robot ---
         self.entrenamiento_activado = False
         self.objetivo_actual = None
+        self._tick_start = 0.0 # Inicio del ciclo actual del bucle de control (time.monotonic)
+        self._sim_rng = np.random.default_rng() # Generador para los datos simulados
+        self._ultima_sonda_registro = None # Momento (time.monotonic) de la última comprobación del servidor de datos
+        self._resultado_sonda_registro = False
         self.latest_sensor_data = {} # Caché para los datos del puerto serie
+        self._ultima_trama = b"" # Bytes de la última trama parseada
+        self._buffer_serie = bytearray() # Bytes recibidos que aún no forman una línea completa
+        self._momento_ultima_trama = 0.0 # time.monotonic() de la última trama válida del ESP32
+        self._nueva_trama = threading.Event() # Lo activa el hilo de lectura al guardar una trama con datos nuevos
+        self._aviso_datos_obsoletos = False
+        self._usa_puerto_serie = False # Se abrió el puerto al arrancar: a partir de ahí los datos deben llegar por él
+        self._estado_cacheado_snap = None # Trama con la que se construyó _estado_cacheado
+        self._estado_cacheado = None
+
+        # --- Cliente HTTP para el registro de datos ---
+        # Una única sesión reutiliza la conexión TCP (keep-alive) en lugar de abrir una nueva por envío.
+        # No usamos HTTP/2: el servidor de recolección es Flask en HTTP plano (solo HTTP/1.1) y los lotes
+        # salen de uno en uno desde un único hilo, así que no habría peticiones que multiplexar.
+        self._http = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=Retry(total=0))
+        self._http.mount("http://", adaptador)
+        self._http.mount("https://", adaptador)
+        # Los envíos se hacen en un hilo aparte para no bloquear el bucle de control.
+        self._cola_registro = queue.Queue(maxsize=64)
+        self._ultima_imagen_id = None # Identificador de la última imagen enviada al servidor
+        self._muestras_descartadas = 0 # Muestras perdidas por tener la cola llena desde el último aviso
+        self._lock_descartadas = threading.Lock() # Lo incrementa el bucle de control y lo reinicia el hilo de envío
+        threading.Thread(target=self._hilo_envio_registro, daemon=True).start()
+
+        # --- Predicción de la IA en segundo plano ---
+        self._ejecutor_ia = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._prediccion_en_curso = None
+        self._ultima_prediccion = "DETENIDO" # Acción segura hasta tener la primera predicción
 
         # --- Inicializar Conexión Serie ---
         try:
             self.ser = serial.Serial(self.SERIAL_PORT, self.BAUD_RATE, timeout=1)
             print(f"Conectado al puerto serie {self.SERIAL_PORT} a {self.BAUD_RATE} baudios.")
+            self._usa_puerto_serie = True
+            try:
+                # ASYNC_LOW_LATENCY (Linux): evita que el driver USB-serie retenga los bytes hasta 16 ms
+                self.ser.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, ValueError, OSError) as e:
+                print(f"Aviso: no se pudo activar el modo de baja latencia del puerto serie: {e}")
+            try:
+                # Buffer del driver para tramas grandes (con imagen); set_buffer_size solo existe en Windows,
+                # en Linux/macOS el buffer del kernel ya es suficiente
+                self.ser.set_buffer_size(rx_size=self.SERIAL_MAX_PENDIENTE)
+            except AttributeError:
+                pass
         except serial.SerialException as e:
             print(f"Error al abrir el puerto serie {self.SERIAL_PORT}: {e}")
             print("El robot funcionará con datos simulados.")
 
+        # --- Lectura del Puerto Serie en segundo plano ---
+        # Los bucles de control solo leen la última trama guardada en latest_sensor_data, nunca esperan al puerto.
+        if self.ser:
+            threading.Thread(target=self._hilo_lectura_serie, daemon=True).start()
+
     # ===================================================================
     # FUNCIONES DE COMPROBACIÓN DE SISTEMAS (Simuladas)
     # ===================================================================
@@ -50,14 +213,23 @@ class RobotController:
         return True # Simulación: siempre OK
 
     def comprobar_script_entrenamiento(self):
+        # Si se ha comprobado hace poco, reutilizamos el resultado en lugar de volver a sondear el servidor
+        ahora = time.monotonic()
+        if self._ultima_sonda_registro is not None and ahora - self._ultima_sonda_registro < 30:
+            return self._resultado_sonda_registro
+
         print("Comprobando script de registro de datos...")
         try:
             # Intenta hacer una petición simple para ver si el servidor responde.
-            # Un 405 (Method Not Allowed) en /log significa que el servidor está vivo.
-            requests.get(self.DATA_COLLECTION_URL, timeout=1)
-            return True
+            # Un 405 (Method Not Allowed) en /log significa que el servidor está vivo. HEAD no descarga cuerpo.
+            self._http.head(self.DATA_COLLECTION_URL, timeout=0.5, allow_redirects=False)
+            disponible = True
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-            return False
+            disponible = False
+
+        self._ultima_sonda_registro = ahora
+        self._resultado_sonda_registro = disponible
+        return disponible
 
     def comprobar_modelo_ia_disponible(self):
         print(f"Comprobando si existe el modelo de IA en {self.RUTA_MODELO_IA}...")
@@ -70,30 +242,139 @@ class RobotController:
 
     def ejecutar_movimiento(self, accion):
         """Centraliza el control de los motores basado en la acción decidida."""
-        print(f"MOTOR: Ejecutando '{accion}'")
+        if accion != "DETENIDO" and self._datos_sensores_obsoletos():
+            # Sin tramas recientes del ESP32 las decisiones se basan en datos viejos: mejor pararse
+            if not self._aviso_datos_obsoletos:
+                log.warning("SEGURIDAD: No llegan datos de los sensores. Robot detenido hasta recibirlos.")
+                self._aviso_datos_obsoletos = True
+            accion = "DETENIDO"
+        else:
+            self._aviso_datos_obsoletos = False
+        log.debug("MOTOR: Ejecutando '%s'", accion)
         # Aquí iría el código GPIO para controlar los motores
         # Ejemplo:
         # if accion == "AVANZAR": self.mandar_senal_avance()
         # ...
 
+    def _datos_sensores_obsoletos(self):
+        """
+        Indica si el robot arrancó con puerto serie y la última trama válida es demasiado antigua
+        o la conexión se ha perdido.
+        """
+        if not self._usa_puerto_serie:
+            return False
+        ser = self.ser
+        return not ser.is_open or time.monotonic() - self._momento_ultima_trama > self.SENSORES_MAX_ANTIGUEDAD
+
+    def _hilo_lectura_serie(self):
+        """Lee continuamente el puerto serie mientras esté abierto."""
+        while self.ser is not None and self.ser.is_open:
+            self._read_and_cache_serial_data()
+
     def _read_and_cache_serial_data(self):
-        """Lee una línea del ESP32, la parsea y la guarda en la caché."""
-        if not self.ser or not self.ser.is_open:
+        """
+        Espera la siguiente trama del ESP32, vacía el buffer y guarda en la caché solo la más reciente.
+        Las tramas anteriores ya están obsoletas, así que ni siquiera se parsean.
+        """
+        ser = self.ser
+        if not ser or not ser.is_open:
             # Si no hay conexión serie, no hacemos nada. Las funciones usarán datos viejos o simulados.
             return
 
         try:
-            if self.ser.in_waiting > 0:
-                line = self.ser.readline().decode('utf-8').rstrip()
-                if line:
-                    self.latest_sensor_data = json.loads(line)
-                    # print("Datos recibidos del ESP32:", self.latest_sensor_data) # Descomentar para depurar
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-            print(f"Error al procesar datos del puerto serie: {e}")
+            if self.SERIAL_TRAMAS_CON_LONGITUD:
+                trama = self._leer_trama_con_longitud(ser)
+            else:
+                trama = self._leer_trama_por_lineas(ser)
+
+            if not trama.strip():
+                return
+            if trama == self._ultima_trama:
+                # Una trama idéntica a la última válida no aporta nada: nos ahorramos parsearla, pero sigue vigente
+                self._momento_ultima_trama = time.monotonic()
+                return
+
+            datos = _json_loads(trama)
+            if not isinstance(datos, dict):
+                # JSON válido pero no es una trama (p. ej. una lista o un número): los bucles esperan un dict
+                raise TypeError(f"Trama no es un objeto JSON: {type(datos).__name__}")
+            if 'lidar' in datos:
+                datos['lidar'] = self._lidar_a_array(datos['lidar'])
+            # Sustituimos el diccionario entero: la asignación es atómica, los lectores no necesitan lock.
+            self.latest_sensor_data = datos
+            # Solo una trama que se ha podido parsear cuenta como última trama y renueva la antigüedad:
+            # una trama malformada repetida no debe hacer pasar por recientes los datos anteriores
+            self._ultima_trama = trama
+            self._momento_ultima_trama = time.monotonic()
+            self._nueva_trama.set()
+            # print("Datos recibidos del ESP32:", self.latest_sensor_data) # Descomentar para depurar
+        except (ValueError, TypeError) as e: # Incluye los errores de decodificación JSON
+            log.warning("Error al procesar datos del puerto serie: %s", e)
+            if self.SERIAL_TRAMAS_CON_LONGITUD:
+                # Una longitud corrupta desalinea todas las tramas siguientes: vaciamos para resincronizar
+                ser.reset_input_buffer()
         except serial.SerialException as e:
-            print(f"Error de comunicación serie: {e}")
-            self.ser.close()
-            self.ser = None
+            # Se conserva self.ser (cerrado): los bucles siguen leyendo la caché y no pasan a datos
+            # simulados, y _datos_sensores_obsoletos detiene el robot hasta que se reinicie
+            log.error("Error de comunicación serie: %s. Robot detenido.", e)
+            ser.close()
+
+    def _leer_trama_por_lineas(self, ser):
+        """
+        Protocolo por líneas: cada trama es un JSON terminado en '\\n'. Lee de una vez todo lo que
+        haya en el puerto y devuelve la última línea completa no vacía; el resto de la línea a medias se guarda.
+        """
+        buffer = self._buffer_serie
+        # Bloquea hasta recibir al menos un byte (o el timeout del puerto) y trae todo lo pendiente en una sola llamada
+        buffer.extend(ser.read(ser.in_waiting or 1))
+
+        fin = buffer.rfind(b"\n")
+        if fin < 0:
+            if len(buffer) > self.SERIAL_MAX_PENDIENTE:
+                buffer.clear() # Demasiados bytes sin fin de línea: son basura, no una trama
+            return b""
+        consumido = fin + 1
+        while True:
+            inicio = buffer.rfind(b"\n", 0, fin) + 1
+            if inicio == 0 or buffer[inicio:fin].strip():
+                break
+            # Línea en blanco (p. ej. un '\r\n' suelto tras la trama): la trama es la línea anterior
+            fin = inicio - 1
+        trama = bytes(buffer[inicio:fin + 1])
+        del buffer[:consumido] # Las líneas anteriores a la última ya están obsoletas
+        return trama
+
+    def _leer_trama_con_longitud(self, ser):
+        """
+        Protocolo con prefijo de longitud: cada trama son 2 bytes little-endian con la longitud del
+        JSON seguidos del JSON (máximo 65535 bytes). PySerial pide exactamente los bytes de la trama
+        en lugar de buscar el '\\n' byte a byte. El firmware del ESP32 debe escribir cabecera y JSON
+        en una sola escritura para que una trama nunca quede partida. Devuelve la última trama completa.
+        """
+        trama = b""
+        # La primera lectura bloquea hasta el timeout del puerto; las siguientes solo si ya hay datos
+        while not trama or ser.in_waiting >= 2:
+            cabecera = ser.read(2)
+            if len(cabecera) < 2:
+                break
+            longitud = int.from_bytes(cabecera, 'little')
+            datos = ser.read(longitud)
+            if len(datos) < longitud:
+                break
+            trama = datos
+        return trama
+
+    def _lidar_a_array(self, pares):
+        """
+        Convierte la lista de pares (ángulo, distancia) del ESP32 en un array indexado por ángulo.
+        Los ángulos sin lectura y las distancias no finitas quedan en LIDAR_ALCANCE_MAX.
+        """
+        distancias = _LIDAR_VACIO.copy()
+        pares = np.asarray(pares, dtype=np.float32).reshape(-1, 2)
+        if pares.size:
+            distancias[pares[:, 0].astype(np.intp) % 360] = pares[:, 1]
+            np.nan_to_num(distancias, copy=False, nan=LIDAR_ALCANCE_MAX, posinf=LIDAR_ALCANCE_MAX, neginf=LIDAR_ALCANCE_MAX)
+        return distancias
 
     def leer_sensor_ultrasonidos(self, sensor):
         """Lee la distancia de un sensor de ultrasonidos desde la caché."""
@@ -103,11 +384,11 @@ class RobotController:
             return random.uniform(5.0, 400.0)
 
     def leer_datos_completos_lidar(self):
-        """Lee los datos del Lidar desde la caché."""
+        """Lee los datos del Lidar desde la caché: array de 360 distancias donde el índice es el ángulo."""
         if self.ser:
-            return self.latest_sensor_data.get('lidar', [])
+            return self.latest_sensor_data.get('lidar', _LIDAR_VACIO)
         else: # Modo simulación
-            return [(angulo, random.uniform(10.0, 800.0)) for angulo in range(360)]
+            return self._sim_rng.uniform(10.0, 800.0, 360).astype(np.float32)
 
     def capturar_imagen_actual(self):
         """Obtiene la imagen en formato Base64 desde la caché."""
@@ -119,7 +400,7 @@ class RobotController:
     def leer_datos_posicionamiento_visual(self):
         """Lee los datos de odometría visual desde la caché."""
         if self.ser:
-            return self.latest_sensor_data.get('visual', {"x": 0, "y": 0, "orientacion": 0})
+            return self.latest_sensor_data.get('visual', _POSICION_VACIA)
         else: # Modo simulación
             return {"x": random.uniform(0.0, 20.0), "y": random.uniform(0.0, 20.0), "orientacion": random.uniform(0.0, 359.9)}
 
@@ -128,26 +409,110 @@ class RobotController:
     # ===================================================================
 
     def predecir_accion_con_ia(self, estado_actual):
+        """
+        Devuelve la última predicción ya terminada y lanza la siguiente en segundo plano,
+        así el bucle de control nunca espera a la IA (va como mucho un ciclo por detrás).
+        """
+        futuro = self._prediccion_en_curso
+        if futuro is None or futuro.done():
+            if futuro is not None:
+                try:
+                    self._ultima_prediccion = futuro.result()
+                except Exception as e:
+                    log.warning("IA: Error al predecir la acción: %s", e)
+            self._prediccion_en_curso = self._ejecutor_ia.submit(self._predecir_accion, estado_actual)
+        return self._ultima_prediccion
+
+    def _predecir_accion(self, estado_actual):
         """Placeholder para la predicción de la IA."""
         # En el futuro, esto haría una petición POST a self.AI_PREDICTION_URL
-        print("IA: Prediciendo acción (simulado)...")
-        acciones_posibles = ["AVANZAR", "GIRAR_DERECHA", "GIRAR_IZQUIERDA", "RETROCEDER", "DETENIDO"]
-        return random.choice(acciones_posibles)
+        log.debug("IA: Prediciendo acción (simulado)...")
+        return _ACCIONES[random.randrange(len(_ACCIONES))]
 
     def enviar_a_script_entrenamiento(self, estado_completo, accion_tomada):
-        """Envía el estado y la acción al servidor de recolección de datos."""
-        print(f"REGISTRO: Enviando estado y acción '{accion_tomada}' al servidor...")
+        """Encola el estado y la acción para que el hilo de registro los envíe al servidor."""
+        payload = {
+            "estado_completo": estado_completo,
+            "accion_tomada": accion_tomada,
+            "ts": time.time()
+        }
         try:
-            payload = {
-                "estado_completo": estado_completo,
-                "accion_tomada": accion_tomada
-            }
-            # Se envía el payload como JSON. timeout para no bloquear el robot indefinidamente.
-            response = requests.post(self.DATA_COLLECTION_URL, json=payload, timeout=2)
+            self._cola_registro.put_nowait(payload)
+        except queue.Full:
+            # Si el servidor no da abasto descartamos la muestra: el robot no debe esperar.
+            with self._lock_descartadas:
+                self._muestras_descartadas += 1
+
+    def _hilo_envio_registro(self):
+        """
+        Consume la cola de registro y agrupa las muestras en lotes. Un lote se envía
+        al llenarse o cuando su primera muestra lleva REGISTRO_INTERVALO_MAX segundos esperando.
+        """
+        pendientes = []
+        inicio_lote = 0.0
+        while True:
+            timeout = None if not pendientes else max(0.0, inicio_lote + self.REGISTRO_INTERVALO_MAX - time.monotonic())
+            try:
+                payload = self._cola_registro.get(timeout=timeout)
+                if not pendientes:
+                    inicio_lote = time.monotonic()
+                pendientes.append(payload)
+            except queue.Empty:
+                pass
+
+            if len(pendientes) >= self.REGISTRO_TAMANO_LOTE or \
+               (pendientes and time.monotonic() - inicio_lote >= self.REGISTRO_INTERVALO_MAX):
+                self._enviar_lote(pendientes)
+                pendientes = []
+
+    def _enviar_lote(self, lote):
+        """Envía un lote de muestras al servidor de recolección de datos en una sola petición."""
+        log.debug("REGISTRO: Enviando lote de %d muestras al servidor...", len(lote))
+        with self._lock_descartadas:
+            descartadas, self._muestras_descartadas = self._muestras_descartadas, 0
+        if descartadas:
+            log.warning("REGISTRO: %d muestras descartadas porque la cola de envío estaba llena", descartadas)
+        self._quitar_imagenes_repetidas(lote)
+        try:
+            cuerpo = _json_dumps({"batch": lote})
+        except (TypeError, ValueError) as e:
+            # Un valor que no se puede serializar no debe tumbar el hilo de envío: se pierde solo este lote
+            log.warning("REGISTRO: Lote descartado, no se pudo serializar: %s", e)
+            self._ultima_imagen_id = None
+            return
+        try:
+            # timeout corto: un lote perdido es preferible a acumular retraso.
+            response = self._http.post(
+                self.DATA_COLLECTION_BATCH_URL,
+                data=cuerpo,
+                headers={"Content-Type": "application/json"},
+                timeout=0.5
+            )
             if response.status_code != 200:
-                print(f"REGISTRO: Error al enviar datos. Servidor respondió con {response.status_code}")
+                log.warning("REGISTRO: Error al enviar datos. Servidor respondió con %s", response.status_code)
+                self._ultima_imagen_id = None # El servidor puede no tener la imagen: se reenviará entera
         except requests.exceptions.RequestException as e:
-            print(f"REGISTRO: No se pudo conectar con el servidor de datos. Error: {e}")
+            log.warning("REGISTRO: No se pudo conectar con el servidor de datos. Error: %s", e)
+            self._ultima_imagen_id = None
+
+    def _quitar_imagenes_repetidas(self, lote):
+        """
+        Deja la imagen en base64 solo en las muestras donde cambia. El resto llevan únicamente
+        'imagen_id' y el servidor reutiliza la última imagen guardada con ese identificador.
+        """
+        for payload in lote:
+            estado = payload['estado_completo']
+            imagen = estado.get('imagen_camara')
+            if not imagen:
+                continue
+            # hash() de un str se calcula una vez y queda guardado en el propio objeto
+            imagen_id = hash(imagen)
+            # Copia superficial: el estado original puede estar usándolo la predicción de la IA
+            estado = dict(estado, imagen_id=imagen_id)
+            if imagen_id == self._ultima_imagen_id:
+                estado['imagen_camara'] = ""
+            self._ultima_imagen_id = imagen_id
+            payload['estado_completo'] = estado
 
     # ===================================================================
     # FUNCIONES AUXILIARES Y DE LÓGICA
@@ -157,7 +522,7 @@ class RobotController:
         """Simula la obtención de un objetivo desde un servidor."""
         if not self.objetivo_actual:
             self.objetivo_actual = {"x": 15.0, "y": 18.0}
-        print(f"Navegando hacia el objetivo: {self.objetivo_actual}")
+        log.debug("Navegando hacia el objetivo: %s", self.objetivo_actual)
         return self.objetivo_actual
 
     def encontrar_distancia_minima(self, datos_lidar, angulo_inicio, angulo_fin):
@@ -165,45 +530,78 @@ class RobotController:
         # Normaliza los ángulos para que estén en el rango 0-359
         angulo_inicio = (angulo_inicio + 360) % 360
         angulo_fin = (angulo_fin + 360) % 360
-        
-        distancias_sector = []
-        if angulo_inicio <= angulo_fin:
-            for angulo, dist in datos_lidar[angulo_inicio:angulo_fin+1]:
-                distancias_sector.append(dist)
-        else: # El sector cruza el ángulo 0 (ej. de 315 a 45)
-            for angulo, dist in datos_lidar[angulo_inicio:] + datos_lidar[:angulo_fin+1]:
-                distancias_sector.append(dist)
-        
-        return min(distancias_sector) if distancias_sector else float('inf')
+        return float(_sector_min(datos_lidar, angulo_inicio, angulo_fin))
+
+    def _iniciar_ciclos(self):
+        """Marca el inicio del primer ciclo de un bucle de control."""
+        self._tick_start = time.monotonic()
+
+    def _esperar_siguiente_ciclo(self, periodo):
+        """
+        Duerme hasta el inicio del siguiente ciclo. El plazo se cuenta desde el inicio del ciclo
+        anterior, así el tiempo de lectura, decisión y motores no alarga el periodo.
+        """
+        self._tick_start += periodo
+        espera = self._tick_start - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        else:
+            self._tick_start = time.monotonic() # Ciclo excedido: no intentamos recuperar el retraso
+
+    def _esperar_nueva_trama(self, espera_max):
+        """
+        Espera a que el hilo de lectura guarde una trama nueva del ESP32, como mucho espera_max segundos,
+        para decidir en cuanto llegan datos en lugar de en el siguiente ciclo fijo. Sin puerto serie
+        (simulación) no llegan tramas y se espera un ciclo normal.
+        """
+        if not self.ser:
+            self._esperar_siguiente_ciclo(espera_max)
+            return
+        self._nueva_trama.wait(espera_max)
+        # Lo que llegue a partir de aquí se lee en este mismo ciclo (siempre se usa la última trama)
+        self._nueva_trama.clear()
+
+    def _dist_min_sector(self, datos_lidar, sector):
+        """Distancia mínima en uno de los sectores precalculados del Lidar."""
+        return float(_sector_min(datos_lidar, *sector))
 
     def calcular_angulo(self, pos_origen, pos_destino):
-        """Calcula el ángulo en grados desde el origen al destino."""
+        """Calcula el ángulo en radianes desde el origen al destino."""
         delta_x = pos_destino['x'] - pos_origen['x']
         delta_y = pos_destino['y'] - pos_origen['y']
-        return math.degrees(math.atan2(delta_y, delta_x))
+        return math.atan2(delta_y, delta_x)
 
     def distancia(self, pos_origen, pos_destino):
         """Calcula la distancia euclidiana entre dos puntos."""
         return math.sqrt((pos_destino['x'] - pos_origen['x'])**2 + (pos_destino['y'] - pos_origen['y'])**2)
 
+    def _distancia_cuadrado(self, pos_origen, pos_destino):
+        """Distancia euclidiana al cuadrado: basta para comparar con un umbral sin calcular la raíz."""
+        dx = pos_destino['x'] - pos_origen['x']
+        dy = pos_destino['y'] - pos_origen['y']
+        return dx*dx + dy*dy
+
     def resolver_obstaculos_locales_con_estado(self, estado):
         """Decide una acción segura basada solo en sensores de proximidad."""
         DISTANCIA_SEGURIDAD_ULTRA = 15.0  # cm
         
-        dist_min_frontal = self.encontrar_distancia_minima(estado['datos_lidar'], -45, 45)
-        dist_min_derecha = self.encontrar_distancia_minima(estado['datos_lidar'], -135, -45)
-        dist_min_izquierda = self.encontrar_distancia_minima(estado['datos_lidar'], 45, 135)
-
-        if dist_min_frontal > 50.0 and estado['distancias_ultra']['frontal'] > DISTANCIA_SEGURIDAD_ULTRA:
-            return "AVANZAR"
-        elif dist_min_derecha > dist_min_izquierda and dist_min_derecha > 40.0 and estado['distancias_ultra']['derecho'] > DISTANCIA_SEGURIDAD_ULTRA:
-            return "GIRAR_DERECHA"
-        elif dist_min_izquierda > 40.0 and estado['distancias_ultra']['izquierdo'] > DISTANCIA_SEGURIDAD_ULTRA:
-            return "GIRAR_IZQUIERDA"
-        elif estado['distancias_ultra']['trasero'] > DISTANCIA_SEGURIDAD_ULTRA:
-            return "RETROCEDER"
-        else:
-            return "DETENIDO"
+        datos_lidar = estado['datos_lidar']
+        dist_min_frontal = self._dist_min_sector(datos_lidar, self._sector_frontal)
+        dist_min_derecha = self._dist_min_sector(datos_lidar, self._sector_derecha)
+        dist_min_izquierda = self._dist_min_sector(datos_lidar, self._sector_izquierda)
+
+        ultra = estado['distancias_ultra']
+
+        # Se evalúan todas las condiciones de una vez, sin cascada de if/elif; gana la primera
+        # que se cumple en orden de prioridad (la última, DETENIDO, se cumple siempre).
+        permitidas = (
+            (dist_min_frontal > 50.0) & (ultra['frontal'] > DISTANCIA_SEGURIDAD_ULTRA),
+            (dist_min_derecha > dist_min_izquierda) & (dist_min_derecha > 40.0) & (ultra['derecho'] > DISTANCIA_SEGURIDAD_ULTRA),
+            (dist_min_izquierda > 40.0) & (ultra['izquierdo'] > DISTANCIA_SEGURIDAD_ULTRA),
+            ultra['trasero'] > DISTANCIA_SEGURIDAD_ULTRA,
+            True
+        )
+        return _ACCIONES[permitidas.index(True)]
 
     # ===================================================================
     # MODOS DE OPERACIÓN PRINCIPALES
@@ -212,93 +610,136 @@ class RobotController:
     def movimiento_controlado(self):
         print("\n--- MODO: MOVIMIENTO CONTROLADO ---")
         print("Esperando órdenes desde el servidor web...")
+        self._iniciar_ciclos()
         while True:
             # Lógica para leer una pulsación web
-            self._read_and_cache_serial_data() # Leemos por si acaso, aunque no se use
-            print("Leyendo pulsación web...")
-            time.sleep(1)
+            log.debug("Leyendo pulsación web...")
+            self._esperar_siguiente_ciclo(1)
 
     def movimiento_autonomo(self):
         print("\n--- MODO: MOVIMIENTO AUTÓNOMO (Solo Ultrasonidos) ---")
+        PERIODO_DECISION = 0.2 # Segundos entre decisiones: maniobras e intentos de desatasco van a este ritmo
         intentos_fallidos = 0
+        proxima_decision = 0.0 # time.monotonic() a partir del cual toca decidir de nuevo
+        avanzando = False
+        self._iniciar_ciclos()
         while True:
-            self._read_and_cache_serial_data()
-            dist_f = self.leer_sensor_ultrasonidos('frontal')
-            if dist_f > 30.0:
-                self.ejecutar_movimiento("AVANZAR")
+            dist_f, dist_t, dist_r, dist_l = self._snapshot_ultra()
+            # Misma tabla de decisión que resolver_obstaculos_locales_con_estado: gana la primera
+            # condición que se cumple en orden de prioridad (DETENIDO, la última, siempre se cumple)
+            permitidas = (
+                dist_f > 30.0,
+                (dist_r > dist_l) & (dist_r > 20.0),
+                dist_l > 20.0,
+                dist_t > 30.0,
+                True
+            )
+            accion = _ACCIONES[permitidas.index(True)]
+
+            # Se despierta con cada trama nueva, pero entre decisiones solo se reacciona a lo urgente:
+            # frenar si aparece un obstáculo mientras se avanza. Así los intentos se cuentan por periodo
+            # y no por trama. (Sin puerto serie cada espera ya dura un periodo completo.)
+            ahora = time.monotonic()
+            if self.ser and ahora < proxima_decision:
+                if avanzando and accion != "AVANZAR":
+                    self.ejecutar_movimiento("DETENIDO")
+                    avanzando = False
+                self._esperar_nueva_trama(proxima_decision - ahora)
+                continue
+            proxima_decision = ahora + PERIODO_DECISION
+            avanzando = accion == "AVANZAR"
+
+            if accion == "AVANZAR":
                 intentos_fallidos = 0
             else:
-                self.ejecutar_movimiento("DETENIDO")
-                dist_r = self.leer_sensor_ultrasonidos('derecho')
-                dist_l = self.leer_sensor_ultrasonidos('izquierdo')
-                if dist_r > dist_l and dist_r > 20.0:
-                    self.ejecutar_movimiento("GIRAR_DERECHA")
-                elif dist_l > 20.0:
-                    self.ejecutar_movimiento("GIRAR_IZQUIERDA")
-                elif self.leer_sensor_ultrasonidos('trasero') > 30.0:
-                    self.ejecutar_movimiento("RETROCEDER")
-                else:
-                    intentos_fallidos += 1
-                    print(f"Atascado. Intento {intentos_fallidos}/5")
+                self.ejecutar_movimiento("DETENIDO") # Frenar antes de maniobrar
+            if accion == "DETENIDO":
+                intentos_fallidos += 1
+                log.info("Atascado. Intento %d/5", intentos_fallidos)
+            else:
+                self.ejecutar_movimiento(accion)
             
             if intentos_fallidos >= 5:
                 print("Atascado. Descansando 5 minutos...")
                 self.ejecutar_movimiento("DETENIDO")
                 time.sleep(300) # 5 minutos
                 intentos_fallidos = 0
+                proxima_decision = 0.0
+                self._iniciar_ciclos()
             
-            time.sleep(0.2)
+            self._esperar_nueva_trama(PERIODO_DECISION)
 
     def movimiento_autonomo_con_lidar(self):
         print("\n--- MODO: MOVIMIENTO AUTÓNOMO (Solo Lidar) ---")
+        self._iniciar_ciclos()
         while True:
-            self._read_and_cache_serial_data()
             datos_lidar = self.leer_datos_completos_lidar()
-            dist_min_frontal = self.encontrar_distancia_minima(datos_lidar, -45, 45)
+            dist_min_frontal = self._dist_min_sector(datos_lidar, self._sector_frontal)
             
             if dist_min_frontal > 50.0:
                 self.ejecutar_movimiento("AVANZAR")
             else:
                 self.ejecutar_movimiento("DETENIDO")
-                dist_min_derecha = self.encontrar_distancia_minima(datos_lidar, -135, -45)
-                dist_min_izquierda = self.encontrar_distancia_minima(datos_lidar, 45, 135)
+                dist_min_derecha = self._dist_min_sector(datos_lidar, self._sector_derecha)
+                dist_min_izquierda = self._dist_min_sector(datos_lidar, self._sector_izquierda)
                 if dist_min_derecha > dist_min_izquierda and dist_min_derecha > 40.0:
                     self.ejecutar_movimiento("GIRAR_DERECHA")
                 elif dist_min_izquierda > 40.0:
                     self.ejecutar_movimiento("GIRAR_IZQUIERDA")
                 else:
                     self.ejecutar_movimiento("RETROCEDER") # Simplificado
-            time.sleep(0.2)
+            self._esperar_siguiente_ciclo(0.2)
+
+    def _snapshot_ultra(self, snap=None):
+        """Distancias (frontal, trasero, derecho, izquierdo) de los ultrasonidos leídas de una única instantánea."""
+        if not self.ser: # Modo simulación
+            return tuple(self.leer_sensor_ultrasonidos(sensor) for sensor in ("frontal", "trasero", "derecho", "izquierdo"))
+        ultra = (self.latest_sensor_data if snap is None else snap).get('ultrasonidos') or _VACIO
+        return (ultra.get('frontal', 0.0), ultra.get('trasero', 0.0), ultra.get('derecho', 0.0), ultra.get('izquierdo', 0.0))
+
+    def _distancias_ultra(self, snap):
+        """Distancias de los cuatro ultrasonidos, en el formato del estado, a partir de una instantánea de la caché."""
+        frontal, trasero, derecho, izquierdo = self._snapshot_ultra(snap)
+        return {"frontal": frontal, "trasero": trasero, "derecho": derecho, "izquierdo": izquierdo}
 
     def _recopilar_estado_completo(self):
         """Método interno para unificar la recolección de datos de sensores."""
-        # Aseguramos que los datos de la caché están actualizados para este ciclo
-        self._read_and_cache_serial_data()
-        return {
-            "imagen_camara": self.capturar_imagen_actual(),
-            "posicion_visual": self.leer_datos_posicionamiento_visual(),
-            "datos_lidar": self.leer_datos_completos_lidar(),
-            "distancias_ultra": {
-                "frontal": self.leer_sensor_ultrasonidos('frontal'),
-                "trasero": self.leer_sensor_ultrasonidos('trasero'),
-                "derecho": self.leer_sensor_ultrasonidos('derecho'),
-                "izquierdo": self.leer_sensor_ultrasonidos('izquierdo')
-            },
-            "objetivo": self.obtener_coordenada_objetivo_desde_web()
+        # Tomamos una sola instantánea de la caché (la mantiene al día el hilo de lectura del puerto serie),
+        # así todos los sensores del estado salen de la misma trama.
+        snap = self.latest_sensor_data
+        objetivo = self.obtener_coordenada_objetivo_desde_web()
+        if self.ser:
+            # El hilo de lectura sustituye el diccionario con cada trama nueva: si es el mismo objeto,
+            # el estado construido en el ciclo anterior sigue siendo válido.
+            if snap is self._estado_cacheado_snap and objetivo is self._estado_cacheado['objetivo']:
+                return self._estado_cacheado
+            imagen = snap.get('imagen_b64', "")
+            posicion = snap.get('visual', _POSICION_VACIA)
+            datos_lidar = snap.get('lidar', _LIDAR_VACIO)
+        else: # Modo simulación
+            imagen = self.capturar_imagen_actual()
+            posicion = self.leer_datos_posicionamiento_visual()
+            datos_lidar = self.leer_datos_completos_lidar()
+        estado = {
+            "imagen_camara": imagen,
+            "posicion_visual": posicion,
+            "datos_lidar": datos_lidar,
+            "distancias_ultra": self._distancias_ultra(snap),
+            "objetivo": objetivo
         }
+        if self.ser:
+            self._estado_cacheado_snap = snap
+            self._estado_cacheado = estado
+        return estado
 
     def movimiento_autonomo_combinado(self):
         print("\n--- MODO: MOVIMIENTO AUTÓNOMO COMBINADO (Lidar + Ultrasonidos) ---")
+        self._iniciar_ciclos()
         while True:
-            self._read_and_cache_serial_data()
+            snap = self.latest_sensor_data
             estado_sensores = {
-                "datos_lidar": self.leer_datos_completos_lidar(),
-                "distancias_ultra": {
-                    "frontal": self.leer_sensor_ultrasonidos('frontal'),
-                    "trasero": self.leer_sensor_ultrasonidos('trasero'),
-                    "derecho": self.leer_sensor_ultrasonidos('derecho'),
-                    "izquierdo": self.leer_sensor_ultrasonidos('izquierdo')
-                }
+                "datos_lidar": snap.get('lidar', _LIDAR_VACIO) if self.ser else self.leer_datos_completos_lidar(),
+                "distancias_ultra": self._distancias_ultra(snap)
             }
             accion_final = self.resolver_obstaculos_locales_con_estado(estado_sensores)
             
@@ -307,19 +748,20 @@ class RobotController:
                 self.enviar_a_script_entrenamiento(estado_sensores, accion_final)
             
             self.ejecutar_movimiento(accion_final)
-            time.sleep(0.1)
+            self._esperar_siguiente_ciclo(0.1)
 
     def navegacion_por_objetivos(self):
         print("\n--- MODO: NAVEGACIÓN POR OBJETIVOS (Reglas) ---")
-        UMBRAL_ANGULO = 5.0 # grados
+        UMBRAL_ANGULO = math.radians(5.0) # 5 grados, en radianes
         UMBRAL_DISTANCIA = 0.2 # metros
+        UMBRAL_DISTANCIA_CUADRADO = UMBRAL_DISTANCIA * UMBRAL_DISTANCIA
 
+        self._iniciar_ciclos()
         while True:
-            # Recopilar estado ya refresca los datos del puerto serie
             estado_actual = self._recopilar_estado_completo()
             
             # Comprobar si hemos llegado
-            if self.distancia(estado_actual['posicion_visual'], estado_actual['objetivo']) < UMBRAL_DISTANCIA:
+            if self._distancia_cuadrado(estado_actual['posicion_visual'], estado_actual['objetivo']) < UMBRAL_DISTANCIA_CUADRADO:
                 print("¡Objetivo alcanzado!")
                 self.ejecutar_movimiento("DETENIDO")
                 break
@@ -331,7 +773,9 @@ class RobotController:
             accion_final = ""
             if accion_evasion == "AVANZAR":
                 angulo_hacia_objetivo = self.calcular_angulo(estado_actual['posicion_visual'], estado_actual['objetivo'])
-                diferencia_angulo = (angulo_hacia_objetivo - estado_actual['posicion_visual']['orientacion'] + 180) % 360 - 180
+                # La orientación visual llega en grados; remainder deja la diferencia ya envuelta en [-pi, pi]
+                orientacion = math.radians(estado_actual['posicion_visual']['orientacion'])
+                diferencia_angulo = math.remainder(angulo_hacia_objetivo - orientacion, math.tau)
 
                 if abs(diferencia_angulo) > UMBRAL_ANGULO:
                     accion_final = "GIRAR_IZQUIERDA" if diferencia_angulo > 0 else "GIRAR_DERECHA"
@@ -344,12 +788,12 @@ class RobotController:
                 self.enviar_a_script_entrenamiento(estado_actual, accion_final)
             
             self.ejecutar_movimiento(accion_final)
-            time.sleep(0.1)
+            self._esperar_siguiente_ciclo(0.1)
 
     def movimiento_con_IA(self):
         print("\n--- MODO: MOVIMIENTO CON IA (Puro) ---")
+        self._iniciar_ciclos()
         while True:
-            # Recopilar estado ya refresca los datos del puerto serie
             estado_actual = self._recopilar_estado_completo()
             accion_final = self.predecir_accion_con_ia(estado_actual)
 
@@ -357,12 +801,12 @@ class RobotController:
                 self.enviar_a_script_entrenamiento(estado_actual, accion_final)
             
             self.ejecutar_movimiento(accion_final)
-            time.sleep(0.1)
+            self._esperar_siguiente_ciclo(0.1)
 
     def movimiento_combinado_ia_sensores(self):
         print("\n--- MODO: MOVIMIENTO COMBINADO (IA + Sensores) ---")
+        self._iniciar_ciclos()
         while True:
-            # Recopilar estado ya refresca los datos del puerto serie
             estado_actual = self._recopilar_estado_completo()
             
             # La IA sugiere una acción
@@ -374,7 +818,7 @@ class RobotController:
             # Decisión final: la seguridad tiene prioridad
             accion_final = ""
             if accion_sugerida_ia == "AVANZAR" and accion_segura_sensores != "AVANZAR":
-                print(f"SEGURIDAD: La IA quería AVANZAR, pero los sensores lo impiden. Ejecutando '{accion_segura_sensores}'")
+                log.debug("SEGURIDAD: La IA quería AVANZAR, pero los sensores lo impiden. Ejecutando '%s'", accion_segura_sensores)
                 accion_final = accion_segura_sensores
             else:
                 accion_final = accion_sugerida_ia
@@ -383,12 +827,20 @@ class RobotController:
                 self.enviar_a_script_entrenamiento(estado_actual, accion_final)
             
             self.ejecutar_movimiento(accion_final)
-            time.sleep(0.1)
+            self._esperar_siguiente_ciclo(0.1)
 
     # ===================================================================
     # LÓGICA DE ARRANQUE
     # ===================================================================
 
+    def cerrar(self):
+        """Libera las conexiones del robot: sesión HTTP, hilo de predicción y puerto serie."""
+        self._ejecutor_ia.shutdown(wait=False)
+        self._http.close()
+        ser = self.ser
+        if ser and ser.is_open:
+            ser.close()
+
     def run(self):
         """
         Ejecuta las comprobaciones iniciales y lanza el modo de operación apropiado.
@@ -428,12 +880,12 @@ class RobotController:
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     try:
         caren_robot = RobotController()
         caren_robot.run()
     except KeyboardInterrupt:
         print("\nApagando sistema de movilidad.")
-        if caren_robot.ser and caren_robot.ser.is_open:
-            caren_robot.ser.close()
+        caren_robot.cerrar()
         # Aquí podrías añadir una llamada para detener los motores de forma segura
         # caren_robot.ejecutar_movimiento("DETENIDO")
\ No newline at end of file
@@ -1,8 +1,10 @@
 import os
 import time
 import base64
-import io
 import csv
+import glob
+import json
+import threading
 import numpy as np
 import pandas as pd
 from flask import Flask, request, jsonify
@@ -11,9 +13,19 @@ import tensorflow as tf
 from tensorflow.keras.models import Model, load_model
 from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Concatenate
 from tensorflow.keras.utils import to_categorical
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder, StandardScaler
-from PIL import Image
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
+
+# Parser JSON para los cuerpos que envía el robot: orjson (en C, acepta bytes) si está instalado
+_json_loads = orjson.loads if orjson else json.loads
 
 
 class AIModelManager:
@@ -26,35 +38,60 @@ class AIModelManager:
         self.images_path = os.path.join(self.data_path, "imagenes")
         self.models_path = os.path.join(base_path, "models")
         self.dataset_path = os.path.join(self.data_path, "caren_dataset.csv")
+        self.tfrecords_path = os.path.join(self.data_path, "tfrecords")
         self.model_path = os.path.join(self.models_path, "caren_model.h5")
+        # El modelo se guarda también dividido en rama de visión y cabeza (resto de la red), para poder
+        # reutilizar la salida de visión mientras la imagen no cambie; *.tflite es la versión int8 para el robot
+        self.vision_model_path = os.path.join(self.models_path, "caren_vision.h5")
+        self.cabeza_model_path = os.path.join(self.models_path, "caren_cabeza.h5")
+        self.tflite_vision_path = os.path.join(self.models_path, "caren_vision.tflite")
+        self.tflite_cabeza_path = os.path.join(self.models_path, "caren_cabeza.tflite")
 
         # --- Configuración del Modelo ---
         self.image_dims = (64, 64, 3)  # Dimensiones de la imagen (alto, ancho, canales)
         self.num_lidar_points = 360
         self.actions = ["AVANZAR", "GIRAR_DERECHA", "GIRAR_IZQUIERDA", "RETROCEDER", "DETENIDO"]
         self.num_actions = len(self.actions)
+        self.num_numerical_features = 3 + self.num_lidar_points + 6 # posición (3) + Lidar + ultrasonidos (4) + objetivo (2)
+
+        # --- Configuración del Dataset ---
+        # "tfrecord": fragmentos TFRecord con imagen, datos y acción (lectura secuencial al entrenar)
+        # "csv": CSV + un JPEG por muestra (formato antiguo, se sigue pudiendo entrenar con él)
+        self.formato_dataset = "tfrecord"
+        self.muestras_por_fragmento = 50000 # Se abre un fragmento nuevo cada N muestras (~unos cientos de MB)
         
         # --- Estado ---
         self.model = None
-        self.label_encoder = None # Para convertir acciones de texto a números
-        self.scaler = None # Para normalizar datos numéricos
+        self._inferir_vision = None # Funciones de inferencia de cada parte del modelo (TFLite o Keras)
+        self._inferir_cabeza = None
+        self._clave_vision = None # hash de la última imagen que pasó por la rama de visión
+        self._caracteristicas_vision = None # ...y su salida, reutilizada mientras la imagen no cambie
+        # Buffers de entrada reservados una vez y rellenados en cada predicción
+        self._img_buf = np.zeros((1, *self.image_dims), dtype=np.float32)
+        self._num_buf = np.zeros((1, self.num_numerical_features), dtype=np.float32)
+        # (imagen_id, ruta o bytes según el formato) de la última imagen recibida del robot
+        self._ultima_imagen = (None, None)
+        self._csv_file = None # CSV del dataset, abierto mientras corre el servidor de recolección
+        self._csv_writer = None
+        self._escritor_tfrecord = None # Fragmento TFRecord abierto mientras corre el servidor de recolección
+        self._muestras_fragmento = 0
+        self._dataset_lock = threading.Lock() # Las peticiones se atienden en varios hilos a la vez
 
         # Crear directorios si no existen
         os.makedirs(self.images_path, exist_ok=True)
+        os.makedirs(self.tfrecords_path, exist_ok=True)
         os.makedirs(self.models_path, exist_ok=True)
 
     # ===================================================================
     # PARTE 1: RECOLECCIÓN DE DATOS
     # ===================================================================
 
-    def _flatten_data_for_csv(self, estado, accion, ruta_imagen):
-        """Convierte el estado anidado en una lista plana para el CSV."""
-        
-        # Extraer solo las distancias del Lidar
-        lidar_distances = [dist for angulo, dist in estado['datos_lidar']]
-        
-        fila = [
-            ruta_imagen,
+    def _datos_numericos(self, estado):
+        """Devuelve las características numéricas del estado, en el orden de entrada del modelo."""
+        # El Lidar llega como una lista de distancias donde el índice es el ángulo
+        lidar_distances = estado['datos_lidar']
+
+        return [
             estado['posicion_visual']['x'],
             estado['posicion_visual']['y'],
             estado['posicion_visual']['orientacion'],
@@ -65,62 +102,240 @@ class AIModelManager:
             estado['distancias_ultra']['trasero'],
             estado['objetivo']['x'],
             estado['objetivo']['y'],
-            accion
         ]
-        return fila
+
+    def _datos_numericos_validos(self, estado):
+        """
+        Devuelve las características numéricas del estado o None si faltan campos o hay valores
+        nulos o no finitos (null, NaN, inf), que romperían el TFRecord o la normalización del modelo.
+        """
+        try:
+            numericos = self._datos_numericos(estado)
+            valores = np.asarray(numericos, dtype=np.float64)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if valores.shape != (self.num_numerical_features,) or not np.isfinite(valores).all():
+            return None
+        return numericos
+
+    def _flatten_data_for_csv(self, numericos, accion, ruta_imagen):
+        """Convierte las características numéricas del estado en una fila plana para el CSV."""
+        return [ruta_imagen, *numericos, accion]
+
+    def _guardar_muestra(self, estado, accion, timestamp):
+        """
+        Guarda una muestra en el formato de dataset configurado. Devuelve None si se guarda o el motivo
+        por el que se descarta: "invalida" o "imagen_desconocida" (solo trae el imagen_id de una
+        imagen que el servidor no tiene y el robot debe reenviarla entera).
+        """
+        # La imagen se registra antes de validar el resto: aunque esta muestra se descarte, las siguientes
+        # pueden traer solo su imagen_id
+        try:
+            imagen = self._resolver_imagen(estado, timestamp)
+        except (ValueError, TypeError) as e: # base64 corrupto o que no es texto
+            print(f"Aviso: Imagen no válida ({e}), muestra descartada.")
+            return "invalida"
+        if imagen is None:
+            print("Aviso: La muestra hace referencia a una imagen que el servidor no tiene, descartada.")
+            return "imagen_desconocida"
+
+        if accion not in self.actions:
+            print(f"Aviso: Acción desconocida '{accion}', muestra descartada.")
+            return "invalida"
+        numericos = self._datos_numericos_validos(estado)
+        if numericos is None:
+            print("Aviso: Muestra con datos numéricos incompletos o no finitos, descartada.")
+            return "invalida"
+
+        if self.formato_dataset == "tfrecord":
+            self._guardar_muestra_tfrecord(imagen, numericos, accion)
+        else:
+            self._guardar_muestra_csv(imagen, numericos, accion)
+        return None
+
+    def _resolver_imagen(self, estado, timestamp):
+        """
+        Devuelve la imagen de la muestra: los bytes del JPEG (TFRecord) o la ruta del fichero ya guardado
+        (CSV), o b"" / "" si la muestra no trae imagen. Devuelve None si solo trae el imagen_id y no es
+        el de la última imagen recibida (se descartó o el servidor se ha reiniciado desde entonces).
+        """
+        image_b64 = estado.get('imagen_camara')
+        imagen_id = estado.get('imagen_id')
+        en_tfrecord = self.formato_dataset == "tfrecord"
+        if image_b64:
+            imagen = base64.b64decode(image_b64)
+            if not en_tfrecord:
+                # La imagen viene como un JPEG en base64. Guardamos los bytes tal cual: decodificarla y volver
+                # a codificarla con PIL solo gasta CPU del servidor (el redimensionado se hace al entrenar).
+                ruta = os.path.join(self.images_path, f"img_{int(timestamp * 1000)}.jpg")
+                with open(ruta, 'wb') as f:
+                    f.write(imagen)
+                imagen = ruta
+            if imagen_id is not None:
+                self._ultima_imagen = (imagen_id, imagen)
+            return imagen
+        if imagen_id is not None:
+            # El robot no reenvía una imagen que no ha cambiado: repetimos la última recibida
+            return self._ultima_imagen[1] if self._ultima_imagen[0] == imagen_id else None
+        return b"" if en_tfrecord else "" # Sin imagen: al entrenar se usa una imagen negra
+
+    def _guardar_muestra_tfrecord(self, imagen, numericos, accion):
+        """Añade la muestra (JPEG original, datos numéricos y acción) al fragmento TFRecord abierto."""
+        ejemplo = tf.train.Example(features=tf.train.Features(feature={
+            'imagen': tf.train.Feature(bytes_list=tf.train.BytesList(value=[imagen])),
+            'numericos': tf.train.Feature(float_list=tf.train.FloatList(value=numericos)),
+            'accion': tf.train.Feature(int64_list=tf.train.Int64List(value=[self.actions.index(accion)])),
+        }))
+        if self._muestras_fragmento >= self.muestras_por_fragmento:
+            self._abrir_fragmento_tfrecord()
+        self._escritor_tfrecord.write(ejemplo.SerializeToString())
+        self._muestras_fragmento += 1
+
+    def _abrir_fragmento_tfrecord(self):
+        """Cierra el fragmento TFRecord actual (si lo hay) y abre uno nuevo."""
+        if self._escritor_tfrecord is not None:
+            self._escritor_tfrecord.close()
+        # El nombre lleva la marca de tiempo para que los fragmentos se ordenen por fecha de creación
+        ruta = os.path.join(self.tfrecords_path, f"caren_{time.time_ns()}.tfrecord")
+        self._escritor_tfrecord = tf.io.TFRecordWriter(ruta)
+        self._muestras_fragmento = 0
+
+    def _guardar_muestra_csv(self, ruta_imagen, numericos, accion):
+        """Añade la fila de una muestra (imagen ya guardada) al dataset CSV."""
+        # Aplanar y añadir la fila al CSV (queda en el buffer hasta el próximo volcado)
+        csv_row = self._flatten_data_for_csv(numericos, accion, ruta_imagen)
+        self._csv_writer.writerow(csv_row)
+
+    def _abrir_dataset_csv(self):
+        """Abre el CSV del dataset una sola vez para todo el servidor, escribiendo la cabecera si está vacío."""
+        # Buffer grande: las filas se vuelcan a disco una vez por petición, no una por muestra
+        self._csv_file = open(self.dataset_path, 'a', newline='', buffering=1 << 16)
+        self._csv_writer = csv.writer(self._csv_file)
+
+        # En modo 'a' la posición inicial es el final del fichero: 0 si es nuevo o está vacío
+        if self._csv_file.tell() == 0:
+            header = ['ruta_imagen', 'pos_x', 'pos_y', 'orientacion'] + \
+                     [f'lidar_{i}' for i in range(self.num_lidar_points)] + \
+                     ['ultra_f', 'ultra_d', 'ultra_i', 'ultra_t', 'obj_x', 'obj_y', 'accion']
+            self._csv_writer.writerow(header)
+            self._csv_file.flush()
+
+    def _abrir_dataset(self):
+        """Abre el dataset en el formato configurado para todo lo que dure el servidor."""
+        if self.formato_dataset == "tfrecord":
+            self._abrir_fragmento_tfrecord()
+        else:
+            self._abrir_dataset_csv()
+
+    def _volcar_dataset(self):
+        """Vuelca a disco las muestras pendientes (una vez por petición)."""
+        if self._escritor_tfrecord is not None:
+            self._escritor_tfrecord.flush()
+        if self._csv_file is not None:
+            self._csv_file.flush()
+
+    def _cerrar_dataset(self):
+        """Cierra el fragmento TFRecord o el CSV al parar el servidor."""
+        if self._escritor_tfrecord is not None:
+            self._escritor_tfrecord.close()
+            self._escritor_tfrecord = None
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = self._csv_writer = None
 
     def start_data_collection_server(self, host='0.0.0.0', port=5000):
         """Inicia un servidor Flask para recibir y guardar los datos de entrenamiento."""
         app = Flask(__name__)
 
+        def leer_json():
+            """
+            Parsea el cuerpo de la petición directamente desde los bytes. Devuelve un dict, o None si no
+            es JSON válido o no es un objeto.
+            """
+            try:
+                data = _json_loads(request.get_data())
+            except ValueError:
+                return None
+            return data if isinstance(data, dict) else None
+
+        def marca_tiempo(data):
+            """Marca de tiempo enviada por el robot, o la actual si no viene o no es un número."""
+            ts = data.get('ts')
+            return ts if isinstance(ts, (int, float)) and not isinstance(ts, bool) and ts > 0 else time.time()
+
         @app.route('/log', methods=['POST'])
         def log_data():
-            data = request.json
+            data = leer_json() or {}
             estado = data.get('estado_completo')
             accion = data.get('accion_tomada')
 
-            if not estado or not accion:
+            if not isinstance(estado, dict) or not estado or not accion:
                 return jsonify({"status": "error", "message": "Datos incompletos"}), 400
 
-            # La imagen viene como un string en base64. La decodificamos y guardamos.
-            timestamp = int(time.time() * 1000)
-            image_filename = f"img_{timestamp}.jpg"
-            image_path = os.path.join(self.images_path, image_filename)
-            
-            image_b64 = estado.get('imagen_camara')
-            if image_b64:
-                image_data = base64.b64decode(image_b64)
-                image = Image.open(io.BytesIO(image_data))
-                image.save(image_path)
-
-            # Aplanar y guardar en CSV
-            csv_row = self._flatten_data_for_csv(estado, accion, image_path)
-            
-            # Crear cabecera si el archivo no existe
-            if not os.path.exists(self.dataset_path):
-                header = ['ruta_imagen', 'pos_x', 'pos_y', 'orientacion'] + \
-                         [f'lidar_{i}' for i in range(self.num_lidar_points)] + \
-                         ['ultra_f', 'ultra_d', 'ultra_i', 'ultra_t', 'obj_x', 'obj_y', 'accion']
-                with open(self.dataset_path, 'w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(header)
-            
-            # Añadir la nueva fila
-            with open(self.dataset_path, 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(csv_row)
-
+            with self._dataset_lock:
+                motivo = self._guardar_muestra(estado, accion, marca_tiempo(data))
+                self._volcar_dataset()
+            if motivo == "imagen_desconocida":
+                # 409: el robot olvida la última imagen enviada y la próxima vez la manda entera
+                return jsonify({"status": "error", "message": "Imagen desconocida, reenviar completa"}), 409
+            if motivo:
+                return jsonify({"status": "error", "message": "Datos no válidos"}), 400
             return jsonify({"status": "success", "message": "Datos guardados"}), 200
 
+        @app.route('/log/batch', methods=['POST'])
+        def log_batch():
+            # El robot agrupa varias muestras por petición para reducir el coste HTTP por muestra.
+            lote = (leer_json() or {}).get('batch')
+            if not isinstance(lote, list):
+                return jsonify({"status": "error", "message": "Lote no válido"}), 400
+
+            guardadas = 0
+            imagen_desconocida = False
+            with self._dataset_lock:
+                for data in lote:
+                    if not isinstance(data, dict):
+                        continue
+                    estado = data.get('estado_completo')
+                    accion = data.get('accion_tomada')
+                    if not isinstance(estado, dict) or not estado or not accion:
+                        continue
+                    motivo = self._guardar_muestra(estado, accion, marca_tiempo(data))
+                    if motivo is None:
+                        guardadas += 1
+                    elif motivo == "imagen_desconocida":
+                        imagen_desconocida = True
+                self._volcar_dataset()
+
+            if imagen_desconocida:
+                # Las muestras válidas ya están guardadas; el 409 hace que el robot reenvíe la imagen entera
+                return jsonify({"status": "error",
+                                "message": f"{guardadas} muestras guardadas, imagen desconocida"}), 409
+            return jsonify({"status": "success", "message": f"{guardadas} muestras guardadas"}), 200
+
+        self._abrir_dataset()
         print(f"Servidor de recolección de datos iniciado en http://{host}:{port}")
-        app.run(host=host, port=port)
+        try:
+            # Varias peticiones en paralelo (p. ej. un lote y un /log sueltos) no se bloquean entre sí
+            if serve:
+                serve(app, host=host, port=port, threads=4, channel_timeout=10)
+            else:
+                app.run(host=host, port=port, threaded=True)
+        finally:
+            self._cerrar_dataset()
 
     # ===================================================================
     # PARTE 2: ENTRENAMIENTO DEL MODELO
     # ===================================================================
 
-    def _define_multimodal_architecture(self, num_numerical_features):
-        """Define la arquitectura de la red neuronal multimodal usando Keras."""
+    def _define_multimodal_architecture(self, numerical_data):
+        """
+        Define la arquitectura de la red neuronal multimodal usando Keras. La normalización de los datos
+        numéricos se ajusta con numerical_data (array o tf.data.Dataset de lotes) y queda dentro del
+        modelo, así que viaja con él al guardarlo.
+
+        Devuelve (modelo completo, rama de visión, cabeza). Los tres comparten capas (y pesos): se entrena
+        el completo y las dos partes se usan por separado al inferir.
+        """
         # RAMA 1: Procesador de Visión (CNN)
         image_input = tf.keras.layers.Input(shape=self.image_dims, name="entrada_imagen")
         x = tf.keras.layers.Conv2D(24, (5, 5), activation='relu')(image_input)
@@ -128,83 +343,181 @@ class AIModelManager:
         x = tf.keras.layers.Conv2D(36, (5, 5), activation='relu')(x)
         x = tf.keras.layers.MaxPooling2D()(x)
         x = tf.keras.layers.Flatten()(x)
-        vision_output = tf.keras.layers.Dense(50, activation='relu')(x)
+        vision_output = tf.keras.layers.Dense(50, activation='relu', name="salida_vision")(x)
+        vision_model = tf.keras.models.Model(inputs=image_input, outputs=vision_output, name="vision")
 
         # RAMA 2: Procesador de Datos Numéricos (MLP)
-        numerical_input = tf.keras.layers.Input(shape=(num_numerical_features,), name="entrada_numerica")
-        y = tf.keras.layers.Dense(64, activation='relu')(numerical_input)
+        numerical_input = tf.keras.layers.Input(shape=(self.num_numerical_features,), name="entrada_numerica")
+        normalizacion = tf.keras.layers.Normalization(axis=-1, name="normalizacion")
+        normalizacion.adapt(numerical_data)
+        y = normalizacion(numerical_input)
+        y = tf.keras.layers.Dense(64, activation='relu')(y)
         y = tf.keras.layers.Dense(32, activation='relu')(y)
         numerical_output = tf.keras.layers.Dense(16, activation='relu')(y)
 
-        # FUSIÓN: Combinar las dos ramas
-        combined = tf.keras.layers.Concatenate()([vision_output, numerical_output])
-
-        # CABEZA: Capas finales para la toma de decisiones
-        z = tf.keras.layers.Dense(100, activation='relu')(combined)
-        z = tf.keras.layers.Dense(50, activation='relu')(z)
-        output = tf.keras.layers.Dense(self.num_actions, activation='softmax', name="salida_accion")(z)
-
-        # Crear y devolver el modelo final
-        model = tf.keras.models.Model(inputs=[image_input, numerical_input], outputs=output)
-        return model
+        # FUSIÓN + CABEZA: Combinar las dos ramas y capas finales para la toma de decisiones
+        capas_cabeza = [
+            tf.keras.layers.Concatenate(),
+            tf.keras.layers.Dense(100, activation='relu'),
+            tf.keras.layers.Dense(50, activation='relu'),
+            tf.keras.layers.Dense(self.num_actions, activation='softmax', name="salida_accion"),
+        ]
 
-    def train_model(self):
-        """Carga el dataset, define y entrena el modelo de IA."""
-        print("Iniciando proceso de entrenamiento...")
-        
-        # --- 1. Cargar y preparar los datos ---
+        def cabeza(vision):
+            z = capas_cabeza[0]([vision, numerical_output])
+            for capa in capas_cabeza[1:]:
+                z = capa(z)
+            return z
+
+        # Crear y devolver el modelo final y sus dos partes
+        model = tf.keras.models.Model(inputs=[image_input, numerical_input], outputs=cabeza(vision_output))
+        vision_features_input = tf.keras.layers.Input(shape=vision_output.shape[1:], name="entrada_vision")
+        head_model = tf.keras.models.Model(inputs=[vision_features_input, numerical_input],
+                                           outputs=cabeza(vision_features_input), name="cabeza")
+        return model, vision_model, head_model
+
+    def _decodificar_imagen(self, datos):
+        """Decodifica un JPEG (bytes o tensor) a una imagen float32 normalizada de tamaño image_dims."""
+        alto, ancho, canales = self.image_dims
+        imagen = tf.io.decode_image(datos, channels=canales, expand_animations=False)
+        return tf.image.resize(imagen, (alto, ancho)) / 255.0
+
+    def _crear_dataset(self, image_paths, numerical_data, labels, batch_size, barajar):
+        """
+        Crea un tf.data.Dataset que lee y decodifica las imágenes en varios hilos mientras el modelo
+        entrena, y deja preparado el siguiente lote (prefetch) antes de que se pida.
+        """
+        alto, ancho, canales = self.image_dims
+
+        def cargar_muestra(ruta, numericos, etiqueta):
+            imagen = tf.cond(tf.strings.length(ruta) > 0,
+                             lambda: self._decodificar_imagen(tf.io.read_file(ruta)),
+                             lambda: tf.zeros((alto, ancho, canales))) # Imagen negra si no hay datos
+            return (imagen, numericos), etiqueta
+
+        dataset = tf.data.Dataset.from_tensor_slices((image_paths, numerical_data.astype(np.float32), labels))
+        if barajar:
+            dataset = dataset.shuffle(len(image_paths), reshuffle_each_iteration=True)
+        return dataset.map(cargar_muestra, num_parallel_calls=tf.data.AUTOTUNE) \
+                      .batch(batch_size) \
+                      .prefetch(tf.data.AUTOTUNE)
+
+    def _leer_fragmentos_tfrecord(self, fragmentos, validacion):
+        """
+        Lee los ejemplos de los fragmentos TFRecord. Una de cada 5 muestras va a validación; la lectura
+        es secuencial, así que la división es siempre la misma.
+        """
+        descripcion = {
+            'imagen': tf.io.FixedLenFeature([], tf.string),
+            'numericos': tf.io.FixedLenFeature([self.num_numerical_features], tf.float32),
+            'accion': tf.io.FixedLenFeature([], tf.int64),
+        }
+        if validacion:
+            seleccion = lambda i, _: tf.equal(i % 5, 0)
+        else:
+            seleccion = lambda i, _: tf.not_equal(i % 5, 0)
+        return tf.data.TFRecordDataset(fragmentos) \
+                 .enumerate() \
+                 .filter(seleccion) \
+                 .map(lambda _, ejemplo: tf.io.parse_single_example(ejemplo, descripcion),
+                      num_parallel_calls=tf.data.AUTOTUNE)
+
+    def _crear_dataset_tfrecord(self, fragmentos, batch_size, validacion):
+        """Crea el tf.data.Dataset de entrenamiento (o validación) a partir de los fragmentos TFRecord."""
+        alto, ancho, canales = self.image_dims
+
+        def cargar_muestra(muestra):
+            imagen = tf.cond(tf.strings.length(muestra['imagen']) > 0,
+                             lambda: self._decodificar_imagen(muestra['imagen']),
+                             lambda: tf.zeros((alto, ancho, canales))) # Imagen negra si no hay datos
+            etiqueta = tf.one_hot(muestra['accion'], self.num_actions)
+            return (imagen, muestra['numericos']), etiqueta
+
+        dataset = self._leer_fragmentos_tfrecord(fragmentos, validacion)
+        if not validacion:
+            dataset = dataset.shuffle(1000, reshuffle_each_iteration=True)
+        return dataset.map(cargar_muestra, num_parallel_calls=tf.data.AUTOTUNE) \
+                      .batch(batch_size) \
+                      .prefetch(tf.data.AUTOTUNE)
+
+    def _crear_datasets_csv(self, batch_size):
+        """
+        Crea los datasets de entrenamiento y validación a partir del CSV (formato antiguo).
+        Devuelve (train_ds, val_ds, datos numéricos) o None si no se puede cargar.
+        """
         if not os.path.exists(self.dataset_path):
             print(f"Error: No se encuentra el archivo de dataset en {self.dataset_path}")
-            return
+            return None
 
         df = pd.read_csv(self.dataset_path)
         print(f"Dataset cargado. {len(df)} muestras encontradas.")
 
-        # Separar características (X) y etiquetas (Y)
+        # Separar etiquetas (Y)
         y = df['accion']
-        X = df.drop('accion', axis=1)
 
-        # Codificar etiquetas de texto a números
-        self.label_encoder = LabelEncoder()
-        y_encoded = self.label_encoder.fit_transform(y)
+        # Codificar etiquetas de texto a números con el orden fijo de self.actions, el mismo que
+        # usa predict_action para traducir el índice predicho (LabelEncoder las ordenaría alfabéticamente)
+        acciones_desconocidas = set(y.unique()) - set(self.actions)
+        if acciones_desconocidas:
+            print(f"Error: Acciones desconocidas en el dataset: {sorted(acciones_desconocidas)}")
+            return None
+        y_encoded = y.map({accion: i for i, accion in enumerate(self.actions)}).to_numpy()
         y_categorical = to_categorical(y_encoded, num_classes=self.num_actions)
 
-        # Separar características de imagen y numéricas
-        X_image_paths = X['ruta_imagen']
-        X_numerical = X.drop('ruta_imagen', axis=1)
+        # Separar características de imagen y numéricas directamente a arrays de NumPy, sin copias
+        # intermedias del DataFrame: columna 0 = ruta de la imagen, última = acción, el resto numéricas
+        # (los datos numéricos se normalizan dentro del modelo, con una capa Normalization)
+        image_paths = df['ruta_imagen'].fillna("").to_numpy(dtype=str) # Ruta vacía: muestra sin imagen
+        X_numerical = df.iloc[:, 1:-1].to_numpy(dtype=np.float32)
+
+        # Filas con valores no finitos (p. ej. Lidar sin lectura guardado como inf por versiones anteriores
+        # del robot) estropearían la normalización, y las que apuntan a una imagen que no existe harían
+        # fallar la lectura: se descartan
+        imagen_existe = np.fromiter((not ruta or os.path.exists(ruta) for ruta in image_paths),
+                                    dtype=bool, count=len(image_paths))
+        filas_validas = np.isfinite(X_numerical).all(axis=1) & imagen_existe
+        if not filas_validas.all():
+            print(f"Aviso: {np.count_nonzero(~filas_validas)} muestras con valores no finitos o sin imagen descartadas.")
+            image_paths, X_numerical, y_categorical = \
+                image_paths[filas_validas], X_numerical[filas_validas], y_categorical[filas_validas]
+
+        # Dividir en conjuntos de entrenamiento (80%) y validación (20%)
+        # (Se dividen los índices para mantener la correspondencia)
+        indices = np.random.default_rng(42).permutation(len(X_numerical))
+        num_validacion = int(len(X_numerical) * 0.2)
+        val_indices, train_indices = indices[:num_validacion], indices[num_validacion:]
 
-        # Normalizar datos numéricos
-        self.scaler = StandardScaler()
-        X_numerical_scaled = self.scaler.fit_transform(X_numerical)
+        train_ds = self._crear_dataset(image_paths[train_indices], X_numerical[train_indices],
+                                       y_categorical[train_indices], batch_size, barajar=True)
+        val_ds = self._crear_dataset(image_paths[val_indices], X_numerical[val_indices],
+                                     y_categorical[val_indices], batch_size, barajar=False)
+        return train_ds, val_ds, X_numerical
 
-        # Dividir en conjuntos de entrenamiento y validación
-        # (Se dividen los índices para mantener la correspondencia)
-        indices = np.arange(len(df))
-        train_indices, val_indices = train_test_split(indices, test_size=0.2, random_state=42)
-
-        # --- 2. Crear un generador de datos para cargar imágenes bajo demanda ---
-        # Esto es esencial para no agotar la memoria RAM con las imágenes
-        def data_generator(image_paths, numerical_data, labels, indices, batch_size=32):
-            num_samples = len(indices)
-            while True:
-                np.random.shuffle(indices)
-                for offset in range(0, num_samples, batch_size):
-                    batch_indices = indices[offset:offset+batch_size]
-                    
-                    batch_images = []
-                    for i in batch_indices:
-                        img_path = image_paths.iloc[i]
-                        img = Image.open(img_path).resize(self.image_dims[:2])
-                        batch_images.append(np.array(img) / 255.0)
-
-                    batch_numerical = numerical_data[batch_indices]
-                    batch_labels = labels[batch_indices]
-                    
-                    yield [np.array(batch_images), batch_numerical], batch_labels
-
-        # --- 3. Definir, compilar y entrenar el modelo ---
-        num_numerical_features = X_numerical_scaled.shape[1]
-        self.model = self._define_multimodal_architecture(num_numerical_features)
+    def train_model(self):
+        """Carga el dataset, define y entrena el modelo de IA."""
+        print("Iniciando proceso de entrenamiento...")
+        batch_size = 32
+
+        # --- 1. Cargar y preparar los datos ---
+        # Las imágenes se cargan bajo demanda, esencial para no agotar la memoria RAM. Se prefieren
+        # los fragmentos TFRecord (lectura secuencial); si no hay, se entrena con el CSV antiguo.
+        fragmentos = sorted(glob.glob(os.path.join(self.tfrecords_path, "*.tfrecord")))
+        if fragmentos:
+            print(f"Dataset: {len(fragmentos)} fragmentos TFRecord en {self.tfrecords_path}")
+            train_ds = self._crear_dataset_tfrecord(fragmentos, batch_size, validacion=False)
+            val_ds = self._crear_dataset_tfrecord(fragmentos, batch_size, validacion=True)
+            # Para ajustar la normalización solo hacen falta los datos numéricos (sin decodificar imágenes)
+            datos_numericos = self._leer_fragmentos_tfrecord(fragmentos, validacion=False) \
+                                  .map(lambda muestra: muestra['numericos']) \
+                                  .batch(256)
+        else:
+            datasets = self._crear_datasets_csv(batch_size)
+            if datasets is None:
+                return
+            train_ds, val_ds, datos_numericos = datasets
+
+        # --- 2. Definir y compilar el modelo ---
+        self.model, vision_model, head_model = self._define_multimodal_architecture(datos_numericos)
         
         self.model.compile(optimizer='adam',
                            loss='categorical_crossentropy',
@@ -213,75 +526,136 @@ class AIModelManager:
         print("Arquitectura del modelo:")
         self.model.summary()
 
-        batch_size = 32
-        train_gen = data_generator(X_image_paths, X_numerical_scaled, y_categorical, train_indices, batch_size)
-        val_gen = data_generator(X_image_paths.values, X_numerical_scaled, y_categorical, val_indices, batch_size)
-
+        # --- 3. Entrenar ---
         print("\nIniciando entrenamiento...")
         self.model.fit(
-            train_gen,
-            steps_per_epoch=len(train_indices) // batch_size,
-            validation_data=val_gen,
-            validation_steps=len(val_indices) // batch_size,
+            train_ds,
+            validation_data=val_ds,
             epochs=10 # Usar más épocas (ej. 50) en un caso real
         )
 
         # --- 4. Guardar el modelo entrenado ---
         self.model.save(self.model_path)
+        vision_model.save(self.vision_model_path)
+        head_model.save(self.cabeza_model_path)
         print(f"\n¡Entrenamiento completado! Modelo guardado en {self.model_path}")
+        self._exportar_tflite(vision_model, head_model, train_ds)
+
+    def _exportar_tflite(self, vision_model, head_model, dataset, num_muestras=100):
+        """
+        Exporta la rama de visión y la cabeza a TFLite cuantizado a int8, calibrando los rangos con
+        muestras reales del dataset. En el robot ocupa ~4 veces menos y se infiere bastante más rápido en ARM.
+        """
+        muestras = list(dataset.unbatch().take(num_muestras))
+
+        def dataset_representativo_vision():
+            for (imagen, _), _ in muestras:
+                yield [imagen[tf.newaxis]]
+
+        def dataset_representativo_cabeza():
+            for (imagen, numericos), _ in muestras:
+                yield [vision_model(imagen[tf.newaxis], training=False), numericos[tf.newaxis]]
+
+        for modelo, dataset_representativo, ruta in (
+                (vision_model, dataset_representativo_vision, self.tflite_vision_path),
+                (head_model, dataset_representativo_cabeza, self.tflite_cabeza_path)):
+            converter = tf.lite.TFLiteConverter.from_keras_model(modelo)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = dataset_representativo
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            with open(ruta, 'wb') as f:
+                f.write(converter.convert())
+            print(f"Modelo int8 para el robot guardado en {ruta}")
 
     # ===================================================================
     # PARTE 3: INFERENCIA (Uso en tiempo real)
     # ===================================================================
 
+    def _cargar_tflite(self, ruta):
+        """
+        Carga un modelo TFLite, reservando sus tensores una sola vez, y devuelve una función que infiere
+        con él. Las entradas se identifican por su forma (cada una tiene una distinta).
+        """
+        interprete = tf.lite.Interpreter(model_path=ruta)
+        interprete.allocate_tensors()
+        entradas = {tuple(entrada['shape']): entrada['index'] for entrada in interprete.get_input_details()}
+        salida = interprete.get_output_details()[0]['index']
+
+        def inferir(*datos):
+            for dato in datos:
+                interprete.set_tensor(entradas[dato.shape], dato)
+            interprete.invoke()
+            return interprete.get_tensor(salida)
+        return inferir
+
+    def _cargar_modelo(self):
+        """
+        Carga las dos partes del modelo para inferir. Se prefiere la versión TFLite int8; si no, los
+        modelos Keras. Con Keras se llama directamente al modelo: predict() monta un Dataset en cada
+        llamada y para un solo ejemplo ese coste supera al de la propia inferencia.
+        """
+        if os.path.exists(self.tflite_vision_path) and os.path.exists(self.tflite_cabeza_path):
+            print(f"Cargando modelo int8 desde {self.tflite_vision_path} y {self.tflite_cabeza_path}...")
+            self._inferir_vision = self._cargar_tflite(self.tflite_vision_path)
+            self._inferir_cabeza = self._cargar_tflite(self.tflite_cabeza_path)
+            return True
+        if os.path.exists(self.vision_model_path) and os.path.exists(self.cabeza_model_path):
+            print(f"Cargando modelo desde {self.vision_model_path} y {self.cabeza_model_path}...")
+            vision_model = load_model(self.vision_model_path)
+            head_model = load_model(self.cabeza_model_path)
+            self._inferir_vision = lambda imagen: vision_model(imagen, training=False).numpy()
+            self._inferir_cabeza = lambda vision, numericos: head_model([vision, numericos], training=False).numpy()
+            return True
+        if os.path.exists(self.model_path):
+            # Modelo completo de un entrenamiento anterior, sin dividir: la "visión" solo guarda una
+            # copia de la imagen y todo el modelo se evalúa en la cabeza
+            print(f"Cargando modelo desde {self.model_path}...")
+            self.model = load_model(self.model_path)
+            self._inferir_vision = lambda imagen: imagen.copy()
+            self._inferir_cabeza = lambda imagen, numericos: self.model([imagen, numericos], training=False).numpy()
+            return True
+        return False
+
     def predict_action(self, estado_actual):
         """Carga el modelo y predice una acción basado en el estado actual."""
-        if self.model is None:
-            if os.path.exists(self.model_path):
-                print(f"Cargando modelo desde {self.model_path}...")
-                self.model = load_model(self.model_path)
-                # Cargar también el encoder y el scaler guardados durante el entrenamiento
-                # En un caso real, deberías guardar y cargar estos objetos con joblib o pickle
-                print("Cargando modelo. (Simulando carga de encoder y scaler)")
-            else:
-                print("Error: Modelo no entrenado o no encontrado.")
-                return "DETENIDO" # Acción segura por defecto
+        if self._inferir_cabeza is None and not self._cargar_modelo():
+            print("Error: Modelo no entrenado o no encontrado.")
+            return "DETENIDO" # Acción segura por defecto
 
         # --- Preparar entradas para el modelo ---
-        # 1. Imagen
+        # 1. Imagen: si el fotograma no ha cambiado (p. ej. robot parado) se reutiliza la salida de la
+        # rama de visión y no se vuelve a decodificar ni a pasar por las convoluciones
         image_b64 = estado_actual.get('imagen_camara')
-        if image_b64:
-            image_data = base64.b64decode(image_b64)
-            img = Image.open(io.BytesIO(image_data)).resize(self.image_dims[:2])
-            img_processed = np.array(img) / 255.0
-            img_processed = np.expand_dims(img_processed, axis=0) # Añadir dimensión de batch
-        else:
-            img_processed = np.zeros((1, *self.image_dims)) # Imagen negra si no hay datos
+        clave_imagen = hash(image_b64) if image_b64 else None
+        if self._caracteristicas_vision is None or clave_imagen != self._clave_vision:
+            if image_b64:
+                # Se decodifica directamente desde los bytes con el mismo decodificador y redimensionado
+                # que se usan al entrenar (sin pasar por BytesIO + PIL ni copias intermedias)
+                self._img_buf[0] = self._decodificar_imagen(base64.b64decode(image_b64))
+            else:
+                self._img_buf.fill(0.0) # Imagen negra si no hay datos
+            self._caracteristicas_vision = self._inferir_vision(self._img_buf)
+            self._clave_vision = clave_imagen
 
         # 2. Datos numéricos
-        lidar_distances = [dist for angulo, dist in estado_actual['datos_lidar']]
-        numerical_features = [
-            estado_actual['posicion_visual']['x'],
-            estado_actual['posicion_visual']['y'],
-            estado_actual['posicion_visual']['orientacion'],
-            *lidar_distances,
-            estado_actual['distancias_ultra']['frontal'],
-            estado_actual['distancias_ultra']['derecho'],
-            estado_actual['distancias_ultra']['izquierdo'],
-            estado_actual['distancias_ultra']['trasero'],
-            estado_actual['objetivo']['x'],
-            estado_actual['objetivo']['y'],
-        ]
-        # numerical_scaled = self.scaler.transform([numerical_features]) # Usar scaler entrenado en un caso real
-        numerical_scaled = np.array([numerical_features]) # Simulación sin scaler
+        # Se escriben por tramos directamente en el buffer; el Lidar (lista o array de distancias, el
+        # índice es el ángulo) se copia de golpe con NumPy en lugar de desempaquetarlo en una lista
+        posicion = estado_actual['posicion_visual']
+        ultra = estado_actual['distancias_ultra']
+        objetivo = estado_actual['objetivo']
+        fin_lidar = 3 + self.num_lidar_points
+        numericos = self._num_buf[0]
+        numericos[:3] = posicion['x'], posicion['y'], posicion['orientacion']
+        numericos[3:fin_lidar] = np.asarray(estado_actual['datos_lidar'], dtype=np.float32)
+        numericos[fin_lidar:] = (ultra['frontal'], ultra['derecho'], ultra['izquierdo'], ultra['trasero'],
+                                 objetivo['x'], objetivo['y'])
 
         # --- Realizar predicción ---
-        prediction_probs = self.model.predict([img_processed, numerical_scaled])
+        prediction_probs = self._inferir_cabeza(self._caracteristicas_vision, self._num_buf)
         predicted_index = np.argmax(prediction_probs[0])
         
-        # Convertir índice a acción de texto
-        # predicted_action = self.label_encoder.inverse_transform([predicted_index])[0] # Usar en caso real
-        predicted_action = self.actions[predicted_index] # Simulación
+        # Convertir índice a acción de texto (mismo orden fijo que al entrenar)
+        predicted_action = self.actions[predicted_index]
 
         print(f"IA: Predicción -> {predicted_action} (Confianza: {prediction_probs[0][predicted_index]:.2f})")
         return predicted_action
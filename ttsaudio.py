@@ -2,62 +2,175 @@ import speech_recognition as sr
 import pyttsx3
 import requests
 import json
+import re
+import numpy as np
+import io
 import os
+import socket
 import time
+import queue
+import tempfile
+import threading
+import wave
+from collections import OrderedDict
 try:
     from piper.config import PiperConfig
     from piper.voice import PiperVoice
-    import wave
 except ImportError:
     PiperVoice = None
 
+try:
+    import sounddevice as sd
+except ImportError:
+    sd = None
+
 try:
     from gtts import gTTS
-    from playsound import playsound
-    import tempfile
 except ImportError:
     gTTS = None
+
+try:
+    from playsound import playsound # Reproduce desde fichero cuando no hay salida de sounddevice
+except ImportError:
+    playsound = None
+
+try:
+    import miniaudio # Decodifica el MP3 de gTTS en memoria
+except ImportError:
+    miniaudio = None
 try:
     import google.generativeai as genai
 except ImportError:
     genai = None
 
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
+
+try:
+    import ahocorasick # pyahocorasick: busca todas las claves de la memoria en una sola pasada
+except ImportError:
+    ahocorasick = None
+
 # --- Configuración ---
 OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
 #OLLAMA_MODEL = "karen-finetuned"  # ¡Tu modelo personalizado!
 OLLAMA_MODEL = "gemma:2b"  # Modelo más ligero, ideal para Raspberry Pi. Descargar con 'ollama pull gemma:2b'
-MEMORY_FILE = "memory.json"
+MEMORY_FILE = "memory.jsonl" # Diario de hechos recordados: una línea por hecho, la última de cada clave manda
+LEGACY_MEMORY_FILE = "memory.json" # Formato anterior (un único JSON), se migra al arrancar
+MEMORY_COMPACT_EVERY = 1000 # Líneas obsoletas en el diario tras las que se reescribe compactado
 TRAINING_LOG_FILE = "training_log.jsonl" # Archivo para guardar conversaciones para futuro entrenamiento
+TRAINING_LOG_BATCH = 16 # Entradas del log de entrenamiento que se escriben juntas...
+TRAINING_LOG_FLUSH_SECONDS = 5 # ...o tiempo máximo que una entrada espera en memoria
+TRAINING_LOG_QUEUE_MAX = 256 # Entradas pendientes de escribir como máximo; con la cola llena se descartan
 WAKE_WORD = "karen"  # Palabra para activar al asistente (en minúsculas)
 WHISPER_MODEL = "small" # 'tiny', 'base', 'small', 'medium'. 'small' es un buen equilibrio. 'medium' puede consumir demasiada RAM.
 CONVERSATION_TIMEOUT = 30 # Segundos de inactividad antes de salir del modo conversación
+FRAGMENT_MAX_TOKENS = 15 # Tokens de Ollama tras los que una coma ya basta para enviar el fragmento a la voz
+SENTENCE_END_RE = re.compile(r'[.!?;:](?=\s|$)') # Fin de frase: el fragmento se puede decir ya
+CLAUSE_END_RE = re.compile(r'[.!?;:,](?=\s|$)')
+
+# --- Configuración para el reconocimiento en streaming (faster-whisper) ---
+ASR_SAMPLE_RATE = 16000 # Frecuencia que espera Whisper
+ASR_BLOCK_SECONDS = 0.1 # Tamaño de cada lectura del micrófono
+ASR_STEP_SECONDS = 1.0 # Cada cuánto audio nuevo se vuelve a transcribir mientras se habla
+ASR_MAX_BUFFER_SECONDS = 30 # Audio sin confirmar que se conserva como máximo (ventana de Whisper)
+PHRASE_TIME_LIMIT = 15 # Duración máxima de una frase en segundos
+ASR_CAPTURE_STALL_SECONDS = 2 # Sin bloques del micrófono durante este tiempo se da la captura por perdida
+VAD_FRAME_SECONDS = 0.03 # webrtcvad analiza tramas de 10, 20 o 30 ms
+VAD_AGGRESSIVENESS = 2 # 0 (acepta más ruido como voz) a 3 (más estricto)
+VAD_PREROLL_SECONDS = 0.2 # Audio anterior a la detección de voz que se conserva (inicio de la primera palabra)
+# Silencio tras el que el VAD da la frase por terminada. 0.3 s cortaba en las pausas normales entre
+# palabras; 0.6 s las respeta y aun así termina la frase medio segundo antes que el pause_threshold (1.2 s)
+VAD_END_SILENCE_SECONDS = 0.6
 
 # --- Configuración para TTS Local de Alta Calidad (Piper) ---
 PIPER_VOICE_ONNX = "tts_models/es_ES-sharvard-medium.onnx"
 PIPER_VOICE_JSON = "tts_models/es_ES-sharvard-medium.onnx.json"
+GTTS_SAMPLE_RATE = 24000 # Frecuencia de la salida de audio si no hay Piper (la de los MP3 de gTTS)
+TTS_CACHE_MAX_BYTES = 10 * 1024 * 1024 # Memoria máxima para el audio ya sintetizado de frases repetidas
+TTS_ENGINE_RETRY_SECONDS = 60 # Cada cuánto se reintenta el motor preferido si se está hablando con uno de respaldo
+# Frases fijas que el asistente dice a menudo: se sintetizan al arrancar para que suenen al instante
+CANNED_PHRASES = ("Sí, dime.", "Pensando...", "De acuerdo. Quedo a la espera.",
+                  "Volviendo a modo de espera por inactividad.")
 
 # --- Configuración para IA Online (Opcional) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") # Obtiene la clave de una variable de entorno
 
-def check_internet_connection(url='http://www.google.com/', timeout=3):
-    """Verifica si hay conexión a internet intentando acceder a una URL."""
+_WHISPER = None # Modelo faster-whisper compartido por todo el reconocimiento de voz (se carga una vez)
+
+def load_whisper_model():
+    """Carga (una sola vez) el modelo de Whisper cuantizado a int8 con faster-whisper; None si no está disponible."""
+    global _WHISPER
+    if _WHISPER is None and WhisperModel:
+        try:
+            print("Cargando modelo de reconocimiento de voz (faster-whisper, int8)...")
+            _WHISPER = WhisperModel(WHISPER_MODEL, device="cpu", compute_type="int8", cpu_threads=4)
+        except Exception as e:
+            print(f"Error al cargar faster-whisper: {e}")
+    return _WHISPER
+
+INTERNET_CHECK_TTL = 5 # Segundos durante los que se reutiliza el resultado de la comprobación de internet
+_internet_status = {"checked_at": None, "ok": False}
+
+def check_internet_connection(host=("1.1.1.1", 53), timeout=1):
+    """
+    Verifica si hay conexión a internet abriendo una conexión TCP a un servidor DNS público (sin HTTP).
+    El resultado se reutiliza durante INTERNET_CHECK_TTL segundos: en un mismo turno se pregunta varias veces.
+    """
+    now = time.monotonic()
+    checked_at = _internet_status["checked_at"]
+    if checked_at is not None and now - checked_at < INTERNET_CHECK_TTL:
+        return _internet_status["ok"]
     try:
-        requests.get(url, timeout=timeout)
-        return True
-    except (requests.ConnectionError, requests.Timeout):
-        return False
+        socket.create_connection(host, timeout=timeout).close()
+        ok = True
+    except OSError:
+        ok = False
+    _internet_status.update(checked_at=time.monotonic(), ok=ok)
+    return ok
 
 class TextToSpeech:
     """
     Gestiona la síntesis de voz.
-    Prioriza un motor online de alta calidad (gTTS) si hay internet.
-    Si no, utiliza un motor offline de respaldo (pyttsx3).
+    Prioriza la voz local de alta calidad (Piper); si no está, un motor online (gTTS) si hay internet
+    y, si no, un motor offline de respaldo (pyttsx3). El motor se elige al iniciar, no en cada frase.
     """
     def __init__(self):
+        self.out_stream = None # Salida de audio siempre abierta por la que suena Piper
+        # Caché LRU de audio ya sintetizado (PCM de la salida) por (motor, texto), limitada en bytes
+        self._audio_cache = OrderedDict()
+        self._audio_cache_bytes = 0
         self.piper_voice = self._init_piper_engine()
+        # Piper solo escribe en la salida abierta a su frecuencia; si no la hay, reproduce desde un WAV
+        self._piper_stream = self.out_stream is not None
+        if self.out_stream is None and gTTS and miniaudio:
+            self.out_stream = self._init_output_stream(GTTS_SAMPLE_RATE)
+        # Piper sintetiza en el hilo de speak() y un hilo aparte escribe el audio en la salida: la
+        # primera parte de la frase ya suena mientras se sintetiza el resto
+        self._tts_q = queue.Queue(maxsize=8)
+        self._frase_terminada = threading.Event()
+        self._speak_lock = threading.Lock()
+        if self.out_stream:
+            threading.Thread(target=self._audio_writer, daemon=True).start()
+        if self.piper_voice and self._piper_stream:
+            try:
+                for phrase in CANNED_PHRASES:
+                    self._cache_put(self._cache_key("piper", phrase), b"".join(self.piper_voice.synthesize_stream_raw(phrase)))
+            except Exception as e:
+                print(f"Advertencia: No se pudieron presintetizar las frases habituales: {e}")
         self.offline_engine = self._init_offline_engine()
         if not gTTS:
             print("Advertencia: La librería 'gTTS' no está instalada. Solo se usará la voz offline.")
+        # Motor con el que se habla; solo se vuelve a elegir si falla (ver _speak)
+        self._preferred_engine = self._pick_engine(check_network=False)
+        self._say = self._pick_engine()
 
     def _init_piper_engine(self):
         """Inicializa el motor de voz local de alta calidad (Piper)."""
@@ -69,16 +182,110 @@ class TextToSpeech:
             print(f"Advertencia: No se encuentra el modelo de voz de Piper en '{PIPER_VOICE_ONNX}'.")
             print("Asegúrate de haberlo descargado en la carpeta 'tts_models'.")
             return None
-        
+
+        if not sd and not playsound:
+            print("Advertencia: No están instaladas ni 'sounddevice' ni 'playsound'. No se podría reproducir la voz de Piper.")
+            return None
+
         try:
             print("Cargando motor de voz local (Piper)...")
             voice = PiperVoice.from_files(PIPER_VOICE_ONNX, PIPER_VOICE_JSON)
             print("Motor de voz Piper cargado correctamente.")
+            self.out_stream = self._init_output_stream(voice.config.sample_rate)
             return voice
         except Exception as e:
             print(f"Error al cargar el motor de voz Piper: {e}")
             return None
 
+    def _init_output_stream(self, sample_rate):
+        """
+        Abre la salida de audio una sola vez y la deja en marcha. El audio de Piper (y el de gTTS ya
+        decodificado) se escribe en ella directamente, sin ficheros temporales ni lanzar un reproductor
+        en cada frase.
+        """
+        if not sd:
+            if playsound:
+                print("Advertencia: La librería 'sounddevice' no está instalada. La voz se reproducirá desde ficheros.")
+            else:
+                print("Advertencia: No están instaladas ni 'sounddevice' ni 'playsound'. Solo se podrá usar la voz offline.")
+            return None
+        try:
+            stream = sd.OutputStream(samplerate=sample_rate, channels=1, dtype='int16', blocksize=0, latency='low')
+            stream.start()
+            return stream
+        except Exception as e:
+            print(f"Error al abrir la salida de audio: {e}")
+            return None
+
+    def _audio_writer(self):
+        """Hilo que escribe en la salida de audio los bloques de PCM que va dejando speak()."""
+        while True:
+            audio_bytes = self._tts_q.get()
+            if audio_bytes is None: # Fin de la frase
+                self._frase_terminada.set()
+                continue
+            try:
+                self.out_stream.write(np.frombuffer(audio_bytes, dtype=np.int16))
+            except Exception as e:
+                print(f"Error al reproducir el audio: {e}")
+
+    def _play_pcm(self, audio_chunks):
+        """
+        Pasa bloques de PCM (int16, mono) al hilo de salida según se van generando y espera a que
+        los haya escrito todos: speak() sigue siendo bloqueante.
+        """
+        self._frase_terminada.clear()
+        try:
+            for audio_bytes in audio_chunks:
+                self._tts_q.put(audio_bytes)
+        finally:
+            self._tts_q.put(None) # Fin de la frase
+            self._frase_terminada.wait()
+
+    def _cache_key(self, engine, text):
+        return (engine, text.strip().lower())
+
+    def _cache_get(self, key):
+        """Devuelve el PCM guardado para la clave (y la marca como la más reciente) o None."""
+        pcm = self._audio_cache.get(key)
+        if pcm is not None:
+            self._audio_cache.move_to_end(key)
+        return pcm
+
+    def _cache_put(self, key, pcm):
+        """Guarda el PCM de una frase, descartando las menos usadas si se supera TTS_CACHE_MAX_BYTES."""
+        if key in self._audio_cache or len(pcm) > TTS_CACHE_MAX_BYTES:
+            return
+        self._audio_cache[key] = pcm
+        self._audio_cache_bytes += len(pcm)
+        while self._audio_cache_bytes > TTS_CACHE_MAX_BYTES:
+            _, old_pcm = self._audio_cache.popitem(last=False)
+            self._audio_cache_bytes -= len(old_pcm)
+
+    def _say_piper(self, text):
+        """Reproduce la frase con Piper, desde la caché si ya se sintetizó antes."""
+        if not self._piper_stream:
+            # Sin salida de audio abierta: se sintetiza a un WAV temporal y se reproduce con playsound
+            with tempfile.NamedTemporaryFile(delete=True, suffix='.wav') as fp:
+                with wave.open(fp.name, 'wb') as wav_file:
+                    self.piper_voice.synthesize(text, wav_file)
+                playsound(fp.name)
+            return
+
+        key = self._cache_key("piper", text)
+        pcm = self._cache_get(key)
+        if pcm is not None:
+            self._play_pcm([pcm])
+            return
+
+        chunks = []
+        def synthesize():
+            for audio_bytes in self.piper_voice.synthesize_stream_raw(text):
+                chunks.append(audio_bytes)
+                yield audio_bytes
+        self._play_pcm(synthesize())
+        self._cache_put(key, b"".join(chunks))
+
     def _init_offline_engine(self):
         """Inicializa el motor de voz offline (pyttsx3) como respaldo."""
         try:
@@ -98,74 +305,327 @@ class TextToSpeech:
             print("En sistemas Debian/Ubuntu, prueba con: sudo apt-get install espeak-ng")
             return None
 
-    def speak(self, text):
-        """Convierte un texto a voz."""
+    def speak(self, text, wait=True):
+        """
+        Convierte un texto a voz. Con wait=False vuelve enseguida y devuelve el hilo que la reproduce,
+        para seguir trabajando mientras suena (join() espera a que termine).
+        """
+        if not wait:
+            thread = threading.Thread(target=self.speak, args=(text,), daemon=True)
+            thread.start()
+            return thread
+        with self._speak_lock: # Una sola frase a la vez
+            self._speak(text)
+
+    def _speak(self, text):
         if not text:
             print("Asistente: (Nada que decir)")
             return
 
         print(f"Asistente: {text}")
 
-        # Prioridad 1: Usar Piper (local, rápido, alta calidad)
-        if self.piper_voice:
-            try:
-                with tempfile.NamedTemporaryFile(delete=True, suffix='.wav') as fp:
-                    with wave.open(fp.name, 'wb') as wav_file:
-                        self.piper_voice.synthesize(text, wav_file)
-                    playsound(fp.name)
-                return # Éxito
-            except Exception as e:
-                print(f"Error con el TTS local (Piper): {e}. Intentando con el siguiente motor.")
+        # Si se quedó en un motor de respaldo (p. ej. se perdió internet), de vez en cuando se
+        # vuelve a probar el preferido
+        if self._say != self._preferred_engine and time.monotonic() - self._engine_picked_at > TTS_ENGINE_RETRY_SECONDS:
+            self._say = self._pick_engine()
 
-        # Prioridad 2: Usar gTTS (online, alta calidad) si Piper falla
-        if gTTS and check_internet_connection():
+        failed = []
+        while self._say:
             try:
-                tts = gTTS(text=text, lang='es', slow=False)
-                with tempfile.NamedTemporaryFile(delete=True, suffix='.mp3') as fp:
-                    tts.save(fp.name)
-                    playsound(fp.name)
+                self._say(text)
                 return # Éxito
             except Exception as e:
-                print(f"Error con el TTS online (gTTS): {e}. Usando motor offline de respaldo.")
-        
-        # Prioridad 3: Usar pyttsx3 (offline, baja calidad) como último recurso
-        if self.offline_engine:
-            self.offline_engine.say(text)
-            self.offline_engine.runAndWait()
+                print(f"Error con el motor de voz ({self._say.__name__}): {e}. Intentando con el siguiente motor.")
+                failed.append(self._say)
+                self._say = self._pick_engine(skip=failed)
+        print("Error: No hay ningún motor de TTS disponible.")
+
+    def _pick_engine(self, skip=(), check_network=True):
+        """
+        Devuelve el método con el que hablar, por orden de preferencia: Piper, gTTS (si hay internet)
+        y pyttsx3. Los motores de skip ya han fallado con la frase actual.
+        """
+        self._engine_picked_at = time.monotonic()
+        if self.piper_voice and (self._piper_stream or playsound) and self._say_piper not in skip:
+            return self._say_piper
+        puede_reproducir_mp3 = playsound or (miniaudio and self.out_stream)
+        if gTTS and puede_reproducir_mp3 and self._say_gtts not in skip and (not check_network or check_internet_connection()):
+            return self._say_gtts
+        if self.offline_engine and self._say_pyttsx not in skip:
+            return self._say_pyttsx
+        return None
+
+    def _say_gtts(self, text):
+        """Reproduce la frase con gTTS (online), desde la caché si ya se descargó antes."""
+        key = self._cache_key("gtts", text)
+        pcm = self._cache_get(key) if miniaudio and self.out_stream else None
+        if pcm is not None:
+            self._play_pcm([pcm])
+            return
+
+        tts = gTTS(text=text, lang='es', slow=False)
+        mp3 = io.BytesIO()
+        tts.write_to_fp(mp3)
+        if miniaudio and self.out_stream:
+            # Se decodifica en memoria a la frecuencia de la salida ya abierta
+            audio = miniaudio.decode(mp3.getvalue(), output_format=miniaudio.SampleFormat.SIGNED16,
+                                     nchannels=1, sample_rate=int(self.out_stream.samplerate))
+            pcm = audio.samples.tobytes()
+            self._play_pcm([pcm])
+            self._cache_put(key, pcm)
+        else:
+            with tempfile.NamedTemporaryFile(delete=True, suffix='.mp3') as fp:
+                fp.write(mp3.getvalue())
+                fp.flush()
+                playsound(fp.name)
+
+    def _say_pyttsx(self, text):
+        """Reproduce la frase con pyttsx3 (offline, baja calidad), el último recurso."""
+        self.offline_engine.say(text)
+        self.offline_engine.runAndWait()
+
+class StreamingListener:
+    """
+    Escucha el micrófono y va transcribiendo con faster-whisper mientras el usuario habla, en lugar de
+    esperar a que termine la frase. Sigue la política LocalAgreement-2 de Whisper-Streaming: las
+    palabras en las que coinciden dos transcripciones seguidas se confirman y su audio se descarta,
+    así al final de la frase solo queda por transcribir un trozo corto.
+
+    El principio y el final de la frase los detecta webrtcvad si está instalado (distingue la voz del
+    ruido mejor que la energía); si no, el umbral de energía calibrado por speech_recognition.
+    """
+    def __init__(self, model, energy_threshold, pause_threshold):
+        self.model = model
+        self.energy_threshold = energy_threshold # Mismo umbral de energía que calibra speech_recognition
+        self.vad = webrtcvad.Vad(VAD_AGGRESSIVENESS) if webrtcvad else None
+        if self.vad:
+            self.block_seconds = VAD_FRAME_SECONDS
+            self.end_silence = VAD_END_SILENCE_SECONDS
         else:
-            print("Error: No hay ningún motor de TTS disponible.")
+            self.block_seconds = ASR_BLOCK_SECONDS
+            self.end_silence = pause_threshold # Segundos de silencio que dan la frase por terminada
+
+    def _is_speech(self, block):
+        if self.vad:
+            return self.vad.is_speech(block.tobytes(), ASR_SAMPLE_RATE)
+        return np.sqrt(np.mean(block.astype(np.float32) ** 2)) > self.energy_threshold
+
+    def _phrase_blocks(self, timeout=None):
+        """
+        Genera los bloques de audio (int16) de la siguiente frase, incluido un poco de audio anterior
+        al inicio de la voz. Termina tras el silencio final, al llegar a PHRASE_TIME_LIMIT o, si no se
+        empieza a hablar, al pasar el timeout (sin generar nada).
+
+        El micrófono se captura en el callback de sounddevice, que deja los bloques en una cola: mientras
+        quien consume los bloques transcribe, la captura sigue sin perder audio. Por eso los tiempos
+        (silencio, límite de la frase, timeout) se cuentan en muestras capturadas y no con el reloj.
+        """
+        block_frames = int(ASR_SAMPLE_RATE * self.block_seconds)
+        end_silence_frames = int(ASR_SAMPLE_RATE * self.end_silence)
+        limit_frames = int(ASR_SAMPLE_RATE * PHRASE_TIME_LIMIT)
+        timeout_frames = None if timeout is None else int(ASR_SAMPLE_RATE * timeout)
+        preroll = []
+        preroll_blocks = max(1, int(VAD_PREROLL_SECONDS / self.block_seconds))
+        speech_started = False
+        position = start = last_voice = 0 # En muestras desde que se abrió el micrófono
+
+        audio_q = queue.Queue()
+        overflows = [0]
+        def callback(indata, frames, time_info, status):
+            if status.input_overflow:
+                overflows[0] += 1
+            audio_q.put_nowait(bytes(indata))
+
+        try:
+            with sd.RawInputStream(samplerate=ASR_SAMPLE_RATE, blocksize=block_frames, channels=1,
+                                   dtype='int16', callback=callback):
+                while True:
+                    try:
+                        data = audio_q.get(timeout=ASR_CAPTURE_STALL_SECONDS)
+                    except queue.Empty:
+                        print("Advertencia: El micrófono ha dejado de enviar audio.")
+                        return
+                    block = np.frombuffer(data, dtype=np.int16)
+                    position += len(block)
+                    if self._is_speech(block):
+                        if not speech_started:
+                            speech_started = True
+                            start = position
+                            yield from preroll
+                        last_voice = position
+                    elif not speech_started:
+                        if timeout_frames is not None and position - start > timeout_frames:
+                            return
+                        # El silencio previo a la frase no se guarda, salvo los últimos bloques
+                        preroll.append(block)
+                        del preroll[:-preroll_blocks]
+                        continue
+                    elif position - last_voice > end_silence_frames:
+                        return # Fin de la frase
+                    yield block
+                    if position - start > limit_frames:
+                        return
+        finally:
+            if overflows[0]:
+                print(f"Advertencia: Se perdió audio del micrófono ({overflows[0]} desbordamientos de entrada).")
+
+    def _transcribe(self, audio, prompt):
+        """Transcribe el audio (int16) y devuelve sus palabras con su instante final en segundos."""
+        samples = audio.astype(np.float32) / 32768.0
+        segments, _ = self.model.transcribe(samples, language="es", beam_size=1, vad_filter=True,
+                                            word_timestamps=True, initial_prompt=prompt or None)
+        return [(word.word.strip(), word.end) for segment in segments for word in segment.words]
+
+    def listen_phrase(self, timeout=None):
+        """Graba la siguiente frase completa y la transcribe de una vez (para la palabra de activación)."""
+        blocks = list(self._phrase_blocks(timeout))
+        if not blocks:
+            return ""
+        samples = np.concatenate(blocks).astype(np.float32) / 32768.0
+        segments, _ = self.model.transcribe(samples, language="es", beam_size=1, vad_filter=True)
+        return "".join(segment.text for segment in segments).strip()
+
+    def listen(self, timeout=None):
+        """Devuelve el texto de la siguiente frase, o "" si no se empieza a hablar antes del timeout."""
+        step_frames = int(ASR_SAMPLE_RATE * ASR_STEP_SECONDS)
+        max_frames = int(ASR_SAMPLE_RATE * ASR_MAX_BUFFER_SECONDS)
+        blocks = [] # Audio aún sin confirmar
+        committed = [] # Palabras ya confirmadas
+        previous = [] # Palabras sin confirmar de la transcripción anterior
+        pending_frames = 0
+
+        for block in self._phrase_blocks(timeout):
+            blocks.append(block)
+            pending_frames += len(block)
+            if pending_frames < step_frames:
+                continue
+            pending_frames = 0
+
+            audio = np.concatenate(blocks)[-max_frames:]
+            words = self._transcribe(audio, " ".join(committed))
+            # LocalAgreement-2: se confirma el prefijo común con la transcripción anterior
+            agreed = 0
+            while (agreed < len(words) and agreed < len(previous)
+                   and words[agreed][0].lower() == previous[agreed].lower()):
+                agreed += 1
+            if agreed:
+                committed.extend(word for word, _ in words[:agreed])
+                print(f"(confirmado) {' '.join(committed)}")
+                audio = audio[int(words[agreed - 1][1] * ASR_SAMPLE_RATE):]
+            previous = [word for word, _ in words[agreed:]]
+            blocks = [audio]
+
+        # Solo queda por transcribir el audio posterior a la última palabra confirmada
+        if blocks:
+            committed.extend(word for word, _ in self._transcribe(np.concatenate(blocks), " ".join(committed)))
+        return " ".join(committed)
 
 class MemoryManager:
-    """Gestiona la memoria a largo plazo del asistente en un archivo JSON."""
-    def __init__(self, filepath):
+    """
+    Gestiona la memoria a largo plazo del asistente. La memoria vive en un diccionario en RAM y en disco
+    es un diario JSONL al que solo se añaden líneas: recordar un hecho no reescribe todo el archivo.
+    """
+    def __init__(self, filepath, legacy_filepath=None):
         self.filepath = filepath
+        self._stale_entries = 0 # Líneas del diario sustituidas por otra posterior con la misma clave
         self.memory = self._load_memory()
+        if not self.memory and legacy_filepath and os.path.exists(legacy_filepath):
+            self._migrate_legacy(legacy_filepath)
+        self._automaton = None # Índice Aho-Corasick de las claves (si está pyahocorasick)
+        self._build_index()
+
+    def _build_index(self):
+        """(Re)construye el índice de claves para buscarlas todas a la vez en el texto."""
+        if not ahocorasick or not self.memory:
+            self._automaton = None
+            return
+        automaton = ahocorasick.Automaton()
+        for key in self.memory:
+            automaton.add_word(key, key)
+        automaton.make_automaton()
+        self._automaton = automaton
 
     def _load_memory(self):
-        """Carga la memoria desde el archivo JSON."""
-        if os.path.exists(self.filepath):
-            with open(self.filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
-
-    def _save_memory(self):
-        """Guarda la memoria en el archivo JSON."""
-        with open(self.filepath, 'w', encoding='utf-8') as f:
-            json.dump(self.memory, f, indent=4, ensure_ascii=False)
+        """
+        Carga la memoria reproduciendo el diario (la última línea de cada clave es la vigente).
+        Una última línea a medias (corte de luz durante una escritura) se elimina del archivo; una
+        línea ilegible en medio se salta. En ambos casos se avisa y el asistente arranca igualmente.
+        """
+        memory = {}
+        if not os.path.exists(self.filepath):
+            return memory
+        with open(self.filepath, 'rb') as f:
+            lines = f.readlines()
+
+        offset = 0 # Posición en bytes del inicio de la línea actual
+        for i, line in enumerate(lines):
+            is_last = i == len(lines) - 1
+            if line.strip():
+                try:
+                    entry = json.loads(line)
+                    key, value = entry['k'], entry['v']
+                except (ValueError, KeyError, TypeError):
+                    if is_last:
+                        print(f"Advertencia: Última línea de '{self.filepath}' incompleta, se descarta.")
+                        os.truncate(self.filepath, offset)
+                        break
+                    print(f"Advertencia: Línea {i + 1} de '{self.filepath}' ilegible, se ignora.")
+                else:
+                    if key in memory:
+                        self._stale_entries += 1
+                    memory[key] = value
+                    if is_last and not line.endswith(b"\n"):
+                        # Línea completa pero sin salto final: lo añadimos para que el siguiente hecho no se pegue a ella
+                        with open(self.filepath, 'ab') as f:
+                            f.write(b"\n")
+            offset += len(line)
+        return memory
+
+    def _migrate_legacy(self, legacy_filepath):
+        """Pasa la memoria del formato anterior (un único JSON) al diario."""
+        with open(legacy_filepath, 'r', encoding='utf-8') as f:
+            self.memory = json.load(f)
+        self._compact()
+        print(f"Memoria: Migrados {len(self.memory)} recuerdos de '{legacy_filepath}' a '{self.filepath}'")
+
+    def _compact(self):
+        """Reescribe el diario con una sola línea por clave (de forma atómica)."""
+        tmp_path = self.filepath + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, value in self.memory.items():
+                f.write(json.dumps({'k': key, 'v': value}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno()) # El contenido debe estar en disco antes de sustituir el diario
+        os.replace(tmp_path, self.filepath)
+        self._stale_entries = 0
 
     def remember(self, key, value):
         """Añade un nuevo hecho a la memoria."""
-        self.memory[key.lower()] = value
-        self._save_memory()
+        key = key.lower()
+        if key in self.memory:
+            self._stale_entries += 1
+        is_new_key = key not in self.memory
+        self.memory[key] = value
+        if is_new_key:
+            self._build_index()
+        if self._stale_entries >= MEMORY_COMPACT_EVERY:
+            self._compact()
+        else:
+            with open(self.filepath, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'k': key, 'v': value}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno()) # Un corte de luz no debe perder un hecho ya confirmado al usuario
         print(f"Memoria: He recordado que '{key}' es '{value}'")
 
     def retrieve_context(self, text):
         """Busca en la memoria hechos relevantes para el texto dado."""
-        context = ""
-        for key, value in self.memory.items():
-            if key in text.lower():
-                context += f"Dato relevante: {key} es {value}. "
-        return context
+        text = text.lower()
+        if self._automaton:
+            # Claves encontradas en el texto, sin repetir, en el orden en que aparecen
+            keys = dict.fromkeys(key for _, key in self._automaton.iter(text))
+        else:
+            keys = [key for key in self.memory if key in text]
+        return "".join(f"Dato relevante: {key} es {self.memory[key]}. " for key in keys)
 
 class Assistant:
     """El asistente personal que escucha, piensa y habla."""
@@ -174,9 +634,17 @@ class Assistant:
         self.recognizer = sr.Recognizer()
         self.microphone = sr.Microphone()
         self.recognizer.pause_threshold = 1.2 # Segundos de silencio para considerar que la frase ha terminado.
+        self.whisper = None # Modelo faster-whisper; si no está, se usa recognize_whisper de speech_recognition
+        self.streaming_listener = None # Reconocimiento en streaming para el modo conversación
         self.tts = TextToSpeech()
-        self.memory = MemoryManager(MEMORY_FILE)
+        self.memory = MemoryManager(MEMORY_FILE, LEGACY_MEMORY_FILE)
         self.running = True  # Flag para controlar el bucle principal
+        # El log de entrenamiento lo escribe un hilo aparte, por lotes, con el archivo abierto una sola vez
+        self._log_q = queue.Queue(maxsize=TRAINING_LOG_QUEUE_MAX)
+        self._log_dropped = 0 # Entradas descartadas por tener la cola llena desde el último aviso
+        self._log_dropped_lock = threading.Lock()
+        self._log_thread = threading.Thread(target=self._log_writer, daemon=True)
+        self._log_thread.start()
 
         # Diccionario de comandos para una fácil expansión
         self.commands = {
@@ -184,15 +652,49 @@ class Assistant:
             "qué sabes sobre": self.command_retrieve_memory,
             "qué hora es": self.command_get_time,
         }
+        # Patrones precompilados: un único regex para todas las palabras clave de los comandos y otro
+        # para la palabra de activación como palabra completa
+        self._cmd_re = re.compile('^(?P<kw>' + '|'.join(re.escape(k) for k in self.commands) + ')(?P<arg>.*)$')
+        self._wake_re = re.compile(rf'\b{re.escape(WAKE_WORD)}\b')
 
         # Ajuste de energía para el ruido ambiental
         with self.microphone as source:
             print("Calibrando micrófono, por favor, guarda silencio...")
             self.recognizer.adjust_for_ambient_noise(source, duration=2)
         print("Calibración finalizada.")
+        self.whisper = load_whisper_model()
+        if self.whisper and sd:
+            self.streaming_listener = StreamingListener(self.whisper, self.recognizer.energy_threshold,
+                                                        self.recognizer.pause_threshold)
+        else:
+            print("Advertencia: 'faster-whisper' o 'sounddevice' no están instalados. La conversación se transcribirá al final de cada frase.")
 
     def listen(self, conversation_mode=False):
         """Escucha la voz del usuario a través del micrófono."""
+        if conversation_mode and self.streaming_listener:
+            listen_timeout = 10  # Segundos de timeout en modo conversación
+            print(f"Escuchando... (timeout en {listen_timeout}s)")
+            try:
+                text = self.streaming_listener.listen(timeout=listen_timeout)
+            except Exception as e:
+                print(f"Error en el reconocimiento en streaming: {e}")
+                return ""
+            if text:
+                print(f"Usuario dijo: {text}")
+            return text.lower()
+
+        if self.streaming_listener and self.streaming_listener.vad:
+            # El VAD detecta la voz con más precisión que el umbral de energía de speech_recognition
+            print("Esperando palabra de activación...")
+            try:
+                text = self.streaming_listener.listen_phrase()
+            except Exception as e:
+                print(f"Error en el reconocimiento de voz: {e}")
+                return ""
+            if text:
+                print(f"Usuario dijo: {text}")
+            return text.lower()
+
         with self.microphone as source:
             # Ajusta el prompt y el timeout según el modo
             if conversation_mode:
@@ -209,8 +711,15 @@ class Assistant:
                 return "" # Ocurrió un timeout, devuelve un string vacío
 
         try:
-            # Usa un modelo de Whisper más grande para mayor precisión
-            text = self.recognizer.recognize_whisper(audio, language="es", model=WHISPER_MODEL)
+            if self.whisper:
+                # Whisper int8 (CTranslate2): mucho más rápido en CPU que el paquete whisper original
+                raw = audio.get_raw_data(convert_rate=ASR_SAMPLE_RATE, convert_width=2)
+                samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+                segments, _ = self.whisper.transcribe(samples, language="es", beam_size=1, vad_filter=True)
+                text = "".join(segment.text for segment in segments).strip()
+            else:
+                # Usa un modelo de Whisper más grande para mayor precisión
+                text = self.recognizer.recognize_whisper(audio, language="es", model=WHISPER_MODEL)
             # Solo imprimimos si se ha detectado algo para no llenar la consola
             if text:
                 print(f"Usuario dijo: {text}")
@@ -223,22 +732,48 @@ class Assistant:
             return ""
 
     def query_llm(self, prompt, context=""):
-        """Envía una consulta al modelo de IA local (Ollama)."""
+        """
+        Envía una consulta al modelo de IA local (Ollama) y va devolviendo la respuesta por fragmentos
+        (frases, o trozos hasta una coma si son largos) según se genera, para poder decirlos ya.
+        Lanza requests.exceptions.RequestException si no se puede conectar.
+        """
         full_prompt = f"Contexto: {context}\n\nPregunta: {prompt}\n\nRespuesta:"
         
         payload = {
             "model": OLLAMA_MODEL,
             "prompt": full_prompt,
-            "stream": False,
+            "stream": True,
             "system": "Eres un asistente de IA llamado Karen. Respondes en español de forma breve y directa."
         }
-        try:
-            response = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=60)
+        with requests.post(OLLAMA_ENDPOINT, json=payload, stream=True, timeout=60) as response:
             response.raise_for_status()
-            response_data = response.json()
-            return response_data.get("response", "Lo siento, no he podido generar una respuesta.").strip()
-        except requests.exceptions.RequestException as e:
-            return f"Error al conectar con el modelo de IA: {e}"
+            text = ""
+            tokens = 0
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except ValueError:
+                    # Una línea truncada o que no es JSON no debe tumbar al asistente: se salta
+                    print(f"Advertencia: Línea no válida en la respuesta de Ollama: {line[:80]!r}")
+                    continue
+                if not isinstance(chunk, dict):
+                    continue
+                text += chunk.get("response", "")
+                tokens += 1
+                # Se envía hasta el último fin de frase (o coma, si el fragmento ya es largo)
+                pattern = CLAUSE_END_RE if tokens >= FRAGMENT_MAX_TOKENS else SENTENCE_END_RE
+                end = None
+                for end in pattern.finditer(text):
+                    pass
+                if end:
+                    fragment, text = text[:end.end()].strip(), text[end.end():]
+                    tokens = 0
+                    if fragment:
+                        yield fragment
+            if text.strip():
+                yield text.strip()
 
     def query_gemini(self, prompt, context=""):
         """Envía una consulta a la API de Gemini como fallback."""
@@ -291,50 +826,127 @@ class Assistant:
     def command_general_query(self, prompt):
         """Maneja cualquier otra consulta enviándola al LLM."""
         # --- Lógica de consulta con fallback ---
-        self.tts.speak("Pensando...")
+        # El aviso suena mientras se consulta al modelo, no antes
+        thinking = self.tts.speak("Pensando...", wait=False)
         context = self.memory.retrieve_context(prompt)
         final_response = ""
         response_was_good = False
         
-        # 1. Intentar con el modelo local (Ollama)
-        local_response = self.query_llm(prompt, context)
+        # 1. Intentar con el modelo local (Ollama). La respuesta llega por fragmentos: el primero se
+        # evalúa antes de decirlo y, si es bueno, cada fragmento suena mientras se genera el siguiente
+        fragments = self.query_llm(prompt, context)
+        try:
+            first_fragment = next(fragments, "")
+        except requests.exceptions.RequestException as e:
+            first_fragment = f"Error al conectar con el modelo de IA: {e}" # El generador queda terminado
+        thinking.join()
+        local_response = first_fragment or "Lo siento, no he podido generar una respuesta."
         
         # 2. Evaluar si la respuesta local es insatisfactoria
-        is_local_response_poor = (
-            "error al conectar" in local_response.lower() or
-            "no he podido generar una respuesta" in local_response.lower() or
-            "no sé" in local_response.lower()
-        )
+        is_local_response_poor = self._is_poor_response(local_response)
 
         if not is_local_response_poor:
             # La respuesta local es buena, la usamos.
-            final_response = local_response
+            spoken = [first_fragment]
+            speaking = self.tts.speak(first_fragment, wait=False)
+            try:
+                for fragment in fragments:
+                    speaking.join()
+                    speaking = self.tts.speak(fragment, wait=False)
+                    spoken.append(fragment)
+            except requests.exceptions.RequestException as e:
+                print(f"Se ha cortado la respuesta del modelo de IA: {e}")
+            speaking.join()
+            final_response = " ".join(spoken)
             response_was_good = True
         else:
             # 3. La respuesta local no es buena, intentamos con el modelo online (Gemini)
-            self.tts.speak("La respuesta local no fue clara. Consultando online...")
+            notice = self.tts.speak("La respuesta local no fue clara. Consultando online...", wait=False)
             if check_internet_connection():
+                fragments.close() # No hace falta el resto de la respuesta local: se cierra la conexión
                 online_response = self.query_gemini(prompt, context)
+                notice.join()
                 final_response = online_response
                 # Asumimos que la respuesta online es buena si no contiene un error
                 if "error" not in online_response.lower():
                     response_was_good = True
             else:
+                notice.join()
                 self.tts.speak("No hay conexión a internet. Usaré la respuesta local.")
-                final_response = local_response # Damos la respuesta local mala como último recurso.
-        
-        self.tts.speak(final_response)
+                # Damos la respuesta local mala (completa) como último recurso.
+                try:
+                    final_response = " ".join([local_response, *fragments])
+                except requests.exceptions.RequestException:
+                    final_response = local_response
+            self.tts.speak(final_response)
+
         if response_was_good:
             self.log_interaction_for_training(prompt, final_response)
 
+    def _is_poor_response(self, response):
+        """Indica si la respuesta del modelo local es un error o una evasiva."""
+        response = response.lower()
+        return (
+            "error al conectar" in response or
+            "no he podido generar una respuesta" in response or
+            "no sé" in response
+        )
+
     def log_interaction_for_training(self, prompt, response):
-        """Guarda la interacción en un archivo para futuro fine-tuning."""
+        """Guarda la interacción en un archivo para futuro fine-tuning (la escribe el hilo del log)."""
         try:
-            with open(TRAINING_LOG_FILE, 'a', encoding='utf-8') as f:
-                log_entry = {"prompt": prompt, "response": response}
-                f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        except Exception as e:
-            print(f"Error al guardar el log de entrenamiento: {e}")
+            self._log_q.put_nowait({"prompt": prompt, "response": response})
+        except queue.Full:
+            # Si el disco no da abasto se pierde la entrada: el asistente no debe esperar por el log
+            with self._log_dropped_lock:
+                self._log_dropped += 1
+
+    def _log_writer(self):
+        """Hilo que escribe el log de entrenamiento por lotes. Un None en la cola lo vacía y lo termina."""
+        pending = []
+        deadline = None
+        running = True
+        with open(TRAINING_LOG_FILE, 'a', encoding='utf-8') as f:
+            while running:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    entry = self._log_q.get(timeout=timeout)
+                    if entry is None:
+                        running = False
+                    else:
+                        pending.append(json.dumps(entry, ensure_ascii=False) + "\n")
+                        if deadline is None:
+                            deadline = time.monotonic() + TRAINING_LOG_FLUSH_SECONDS
+                except queue.Empty:
+                    pass
+                if pending and (not running or len(pending) >= TRAINING_LOG_BATCH or time.monotonic() >= deadline):
+                    with self._log_dropped_lock:
+                        dropped, self._log_dropped = self._log_dropped, 0
+                    if dropped:
+                        print(f"Advertencia: {dropped} entradas del log de entrenamiento descartadas (cola llena).")
+                    try:
+                        f.writelines(pending)
+                        f.flush()
+                    except Exception as e:
+                        print(f"Error al guardar el log de entrenamiento: {e}")
+                    pending.clear()
+                    deadline = None
+
+    def close(self):
+        """
+        Termina el hilo del log de entrenamiento, guardando antes las entradas pendientes. Si el hilo
+        ha muerto o no responde (p. ej. el disco está bloqueado) no se espera indefinidamente.
+        """
+        if not self._log_thread.is_alive():
+            return
+        try:
+            self._log_q.put(None, timeout=TRAINING_LOG_FLUSH_SECONDS)
+        except queue.Full:
+            print("Advertencia: El log de entrenamiento no responde; se pierden las entradas pendientes.")
+            return
+        self._log_thread.join(timeout=TRAINING_LOG_FLUSH_SECONDS)
+        if self._log_thread.is_alive():
+            print("Advertencia: El log de entrenamiento no terminó de escribirse a tiempo.")
 
     def process_command(self, command):
         """Procesa el comando del usuario y decide qué hacer."""
@@ -343,12 +955,11 @@ class Assistant:
             self.command_shutdown()
             return
 
-        # Itera sobre el diccionario de comandos
-        for keyword, function in self.commands.items():
-            if command.startswith(keyword):
-                argument = command.replace(keyword, "", 1).strip()
-                function(argument)
-                return  # Termina después de ejecutar el comando
+        # Busca la palabra clave del comando al principio del texto
+        match = self._cmd_re.match(command)
+        if match:
+            self.commands[match.group('kw')](match.group('arg').strip())
+            return  # Termina después de ejecutar el comando
 
         # Si no coincide con ningún comando, es una pregunta general
         self.command_general_query(command)
@@ -360,11 +971,11 @@ class Assistant:
         while self.running:
             # 1. Espera la palabra de activación
             command = self.listen()
-            if WAKE_WORD in command:
+            if self._wake_re.search(command):
                 self.tts.speak("Sí, dime.")
                 
                 # Procesa el resto del comando si se dijo junto con la palabra de activación
-                prompt = command.replace(WAKE_WORD, "", 1).strip()
+                prompt = self._wake_re.sub("", command, count=1).strip()
                 if prompt:
                     self.process_command(prompt)
 
@@ -389,10 +1000,13 @@ class Assistant:
                         self.process_command(conversation_command)
 
 if __name__ == "__main__":
+    assistant = None
     try:
         assistant = Assistant()
         assistant.run()
     except Exception as e:
         print(f"Ha ocurrido un error fatal: {e}")
     finally:
+        if assistant:
+            assistant.close()
         print("Programa finalizado.")
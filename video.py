@@ -1,7 +1,12 @@
 import tkinter as tk
 import sounddevice as sd
 import numpy as np
-import queue
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 def find_audio_monitor_device():
     """
@@ -27,7 +32,7 @@ def find_audio_monitor_device():
 
 # --- Configuración ---
 DEVICE = find_audio_monitor_device() # Intenta encontrar un monitor de audio, si no, usa el predeterminado.
-CHUNK_SIZE = 1024         # Número de muestras a leer a la vez
+CHUNK_SIZE = 256          # Número de muestras a leer a la vez (~6 ms a 44.1 kHz)
 # Intentar obtener la frecuencia de muestreo por defecto del dispositivo para evitar errores
 try:
     device_info = sd.query_devices(DEVICE, 'input')
@@ -41,6 +46,31 @@ AMPLIFICATION_FACTOR = 2.5  # Factor de amplificación (>1 para picos más grand
 NOISE_GATE_THRESHOLD = 0.01 # Umbral de ruido más bajo para mayor sensibilidad
 
 
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _waveform_kernel(data, amp, gate, half_h, out_y):
+        """
+        Puerta de ruido, amplificación, recorte y escalado a la altura de la ventana
+        en un solo bucle compilado. Escribe en out_y la Y de cada muestra.
+        """
+        s = 0.0
+        for i in range(data.size):
+            s += data[i] * data[i]
+        if s < gate * gate * data.size:
+            for i in range(out_y.size):
+                out_y[i] = half_h
+            return
+        for i in range(out_y.size):
+            v = data[i] * amp
+            if v > 1.0:
+                v = 1.0
+            elif v < -1.0:
+                v = -1.0
+            out_y[i] = half_h * (1.0 - v)
+else:
+    _waveform_kernel = None
+
+
 class AudioVisualizer:
     """
     Clase que gestiona la captura de audio y la visualización
@@ -69,23 +99,35 @@ class AudioVisualizer:
         # La línea que representará la onda. La creamos una vez y luego solo actualizamos sus coordenadas.
         self.line = self.canvas.create_line(0, 0, 0, 0, fill=LINE_COLOR, width=1.5, tags="waveform")
 
-        # Cola para comunicar de forma segura el hilo de audio con el hilo de la GUI
-        self.audio_queue = queue.Queue()
-
         # Puntos en el eje X (horizontales). Son constantes, así que los precalculamos.
         self.x_coords = np.linspace(0, self.width, num=CHUNK_SIZE)
+        # Buffer con el formato que entiende el canvas, [x1, y1, x2, y2, ...], reservado una sola vez:
+        # las X ya quedan escritas y en cada fotograma solo se rellenan las Y
+        self._coords = np.empty(2 * CHUNK_SIZE, dtype=np.float64)
+        self._coords[0::2] = self.x_coords
+        # Buffers de la señal procesada: línea plana para la puerta de ruido y destino de la amplificación
+        self._zero_buf = np.zeros(CHUNK_SIZE, dtype=np.float32)
+        self._amp_buf = np.empty(CHUNK_SIZE, dtype=np.float32)
+
+        if _waveform_kernel is not None:
+            # Se llama una vez aquí para que la compilación de numba no congele el primer fotograma
+            _waveform_kernel(np.zeros(CHUNK_SIZE, dtype=np.float32),
+                             AMPLIFICATION_FACTOR, NOISE_GATE_THRESHOLD, self.height / 2, self._coords[1::2])
 
         try:
-            # Iniciamos el stream de audio
+            # Iniciamos el stream de audio sin callback: la GUI lee directamente del buffer
+            # de PortAudio en cada fotograma, sin hilo intermedio ni cola
             self.stream = sd.InputStream(
                 device=DEVICE,
                 channels=1,
                 samplerate=SAMPLERATE,
-                callback=self.audio_callback,
-                blocksize=CHUNK_SIZE
+                blocksize=CHUNK_SIZE,
+                latency='low'
             )
             self.stream.start()
             print("Stream de audio iniciado correctamente.")
+            # Latencia real que concede el dispositivo, para poder ajustar CHUNK_SIZE
+            print(f"Latencia de entrada: {self.stream.latency * 1000:.1f} ms")
         except Exception as e:
             print(f"Error al iniciar el stream de audio: {e}")
             print("Asegúrate de tener un micrófono conectado y los permisos necesarios.")
@@ -106,56 +148,66 @@ class AudioVisualizer:
         """
         self.master.attributes("-fullscreen", not self.master.attributes("-fullscreen"))
 
-    def audio_callback(self, indata, frames, time, status):
-        """
-        Esta función es llamada por sounddevice en un hilo separado cada vez
-        que hay nuevos datos de audio disponibles.
-        """
-        if status:
-            print(status)
-        # Ponemos los datos del micrófono en la cola para que la GUI los procese
-        self.audio_queue.put(indata[:, 0])
-
     def update_plot(self):
         """
         Actualiza el lienzo (canvas) con los nuevos datos de audio.
         """
         try:
-            # Intentamos obtener datos de la cola sin bloquear el programa
-            while not self.audio_queue.empty():
-                data = self.audio_queue.get_nowait()
-
-                # --- Puerta de Ruido (Noise Gate) ---
-                # Calcula el volumen RMS (una medida de la potencia del sonido)
-                volume = np.sqrt(np.mean(data**2))
-
-                if volume < NOISE_GATE_THRESHOLD:
-                    # Si el sonido es muy bajo, dibuja una línea casi plana
-                    processed_data = np.zeros_like(data)
-                else:
-                    # --- Amplificación ---
-                    # Amplifica la señal para picos más grandes
-                    amplified_data = data * AMPLIFICATION_FACTOR
-                    # Recorta la señal para que no se salga de la pantalla (crea picos planos)
-                    processed_data = np.clip(amplified_data, -1.0, 1.0)
-
-                # Escalamos los datos de audio (rango -1 a 1) a la altura de la ventana
-                # El centro de la pantalla es la amplitud 0
-                y_coords = (self.height / 2) * (1 - processed_data)
-
-                # Combinamos las coordenadas X e Y en un formato que el canvas entiende: [x1, y1, x2, y2, ...]
-                coords = np.column_stack((self.x_coords, y_coords)).flatten()
-
-                # Actualizamos las coordenadas de la línea en lugar de borrarla y crearla de nuevo
-                self.canvas.coords("waveform", *coords)
-
-        except queue.Empty:
-            # Si no hay datos, no hacemos nada
-            pass
+            # Leemos sin bloquear la GUI: solo si ya hay un bloque completo en el buffer
+            available = self.stream.read_available
+            if available < CHUNK_SIZE:
+                return
+
+            # Se vacía todo lo pendiente pero solo se dibuja el bloque más reciente:
+            # lo que haya llegado antes ya no se vería
+            indata, overflowed = self.stream.read(available)
+            if overflowed:
+                print("Advertencia: desbordamiento en la entrada de audio.")
+            data = indata[-CHUNK_SIZE:, 0]
+
+            # Las Y se escriben directamente en el buffer de coordenadas
+            y_coords = self._coords[1::2]
+            if _waveform_kernel is not None:
+                _waveform_kernel(data, AMPLIFICATION_FACTOR, NOISE_GATE_THRESHOLD,
+                                 self.height / 2, y_coords)
+            else:
+                self._process_numpy(data, y_coords)
+
+            # Actualizamos las coordenadas de la línea en lugar de borrarla y crearla de nuevo.
+            # Se pasa la lista plana como un único argumento (Tk la aplana en C) en vez de
+            # desempaquetar miles de floats como argumentos posicionales, y sobre el item
+            # guardado en self.line para no resolver la etiqueta en cada fotograma
+            self.canvas.coords(self.line, self._coords.tolist())
+
         finally:
             # Programamos la próxima actualización. Esto crea el bucle de animación.
-            # 50 ms es aproximadamente 20 fotogramas por segundo (un poco más lento).
-            self.master.after(50, self.update_plot)
+            # 16 ms es aproximadamente 60 fotogramas por segundo.
+            self.master.after(16, self.update_plot)
+
+    def _process_numpy(self, data, y_coords):
+        """
+        Versión NumPy del procesado de la onda, usada cuando numba no está instalado.
+        Escribe en y_coords la altura de cada punto a dibujar.
+        """
+        # --- Puerta de Ruido (Noise Gate) ---
+        # Potencia media (RMS al cuadrado) con un producto escalar: sin el array temporal
+        # de data**2 ni la raíz, comparando contra el umbral al cuadrado
+        power = np.dot(data, data) / data.size
+
+        if power < NOISE_GATE_THRESHOLD ** 2:
+            # Si el sonido es muy bajo, dibuja una línea casi plana
+            processed_data = self._zero_buf
+        else:
+            # --- Amplificación ---
+            # Amplifica la señal para picos más grandes y la recorta para que no se salga
+            # de la pantalla (crea picos planos), todo sobre el mismo buffer
+            processed_data = np.multiply(data, AMPLIFICATION_FACTOR, out=self._amp_buf)
+            np.clip(processed_data, -1.0, 1.0, out=processed_data)
+
+        # Escalamos los datos de audio (rango -1 a 1) a la altura de la ventana
+        # El centro de la pantalla es la amplitud 0
+        np.subtract(1.0, processed_data, out=y_coords)
+        y_coords *= self.height / 2
 
     def on_closing(self):
         """